@@ -1,15 +1,20 @@
 from __future__ import annotations
 from typing import Any, Dict
+import asyncio
+import functools
 import logging
+import os
+import pickle
 import traceback
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 from fastapi import FastAPI, Body, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 
 # Optimized Qiskit imports
 from qiskit_aer import AerSimulator
-from vrp_utils import get_distance_matrix, compute_corridors
+from vrp_utils import get_distance_matrix, compute_corridors, to_geo_soa
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +28,30 @@ ibm_backend = AerSimulator(
     shots=1024  # Default shots
 )
 
+# Matrix-product-state simulators keyed by bond dimension. MPS memory grows
+# polynomially in qubit count (vs 2^K for statevector), which keeps large
+# fleets tractable; QAOA at p<=2 has modest entanglement so a bounded bond
+# dimension loses little accuracy.
+_mps_backends: Dict[int, AerSimulator] = {}
+
+
+def _get_backend(sim_method: str, mps_bond_dimension: int) -> AerSimulator:
+    """Return the shared statevector backend or a cached MPS one."""
+    if sim_method != "matrix_product_state":
+        return ibm_backend
+    backend = _mps_backends.get(mps_bond_dimension)
+    if backend is None:
+        backend = AerSimulator(
+            method='matrix_product_state',
+            matrix_product_state_max_bond_dimension=mps_bond_dimension,
+            matrix_product_state_truncation_threshold=1e-3,
+            max_parallel_threads=4,
+            max_parallel_experiments=2,
+        )
+        _mps_backends[mps_bond_dimension] = backend
+    return backend
+
+
 # Import optimizer after backend initialization
 try:
     from optimizer import optimize_vrp
@@ -36,6 +65,12 @@ except ImportError as e:
             "backend": kwargs.get('backend').name() if hasattr(kwargs.get('backend'), 'name') else "unknown"
         }
 
+# Dedicated pool for the CPU-heavy optimize path: keeps the event loop
+# responsive and gives concurrent requests real parallelism outside the
+# GIL. Requests whose backend cannot cross a process boundary fall back
+# to the loop's default thread pool.
+_OPT_POOL = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2))
+
 app = FastAPI(
     title="Optimized Quantum VRP API", 
     version="0.2.0",
@@ -67,18 +102,21 @@ def root():
     }
 
 @app.post("/optimize")
-def optimize(
+async def optimize(
     request: Dict[str, Any] = Body(..., description="VRP input JSON"),
     shots: int = Query(800, ge=100, le=5000, description="Number of shots (auto-adjusted for large problems)"),
     include_counts: bool = Query(False, description="Include measurement histograms (slower)"),
     method: str = Query("qaoa", description='Assignment method: "qaoa" or "pqc"'),
     qaoa_penalty: float = Query(2.0, gt=0, description="QAOA penalty A for one-hot constraint"),
-    qaoa_p: int = Query(1, ge=1, le=2, description="QAOA layers p (limited for speed)")
+    qaoa_p: int = Query(1, ge=1, le=2, description="QAOA layers p (limited for speed)"),
+    sim_method: str = Query("statevector", description='Simulator method: "statevector" or "matrix_product_state"'),
+    mps_bond_dimension: int = Query(128, ge=2, le=1024, description="Max MPS bond dimension (matrix_product_state only)")
 ):
     start_time = time.time()
-    
+
     try:
-        logger.info(f"Starting optimization: method={method}, shots={shots}")
+        logger.info(f"Starting optimization: method={method}, shots={shots}, sim_method={sim_method}")
+        backend = _get_backend(sim_method, mps_bond_dimension)
         
         if not isinstance(request, dict):
             raise HTTPException(status_code=400, detail="Request must be a JSON object")
@@ -95,10 +133,15 @@ def optimize(
             shots = min(shots, 500)  # Reduce shots for very large problems
             include_counts = False   # Disable counts for speed
 
+        # Parse coordinates into contiguous arrays once; the distance-matrix
+        # and per-depot corridor passes below all reuse them
+        depot_soa = to_geo_soa(depots)
+        loc_soa = to_geo_soa(locations)
+
         # Pre-compute distance matrices (with timeout for large problems)
         matrix_start = time.time()
         try:
-            distance_matrix, duration_matrix = get_distance_matrix(depots, locations)
+            distance_matrix, duration_matrix = get_distance_matrix(depot_soa, loc_soa)
             matrix_time = time.time() - matrix_start
             
             if matrix_time > 30:  # If matrix computation is slow
@@ -112,7 +155,7 @@ def optimize(
         corridors_info = {}
         for depot in depots:
             try:
-                corridors_info[depot['id']] = compute_corridors(depot, locations, tolerance=30)
+                corridors_info[depot['id']] = compute_corridors(depot, loc_soa, tolerance=30)
             except Exception as e:
                 logger.warning(f"Corridor computation failed for depot {depot.get('id', 'unknown')}: {e}")
                 corridors_info[depot['id']] = [[loc['id'] for loc in locations]]  # Single corridor fallback
@@ -122,16 +165,25 @@ def optimize(
         request["duration_matrix"] = duration_matrix
         request["corridors"] = corridors_info
 
-        # Call optimized optimizer
-        result = optimize_vrp(
+        # Call optimized optimizer off the event loop; process pool when the
+        # backend pickles, default thread pool otherwise
+        call = functools.partial(
+            optimize_vrp,
             request,
             shots=shots,
             include_counts=include_counts,
             method=method,
             qaoa_penalty=qaoa_penalty,
             qaoa_p=qaoa_p,
-            backend=ibm_backend,
+            backend=backend,
         )
+        loop = asyncio.get_event_loop()
+        try:
+            pickle.dumps(backend)
+            executor = _OPT_POOL
+        except Exception:
+            executor = None  # loop default thread pool
+        result = await loop.run_in_executor(executor, call)
         
         # Add API-level timing info
         total_time = time.time() - start_time
@@ -278,17 +330,14 @@ def benchmark():
         n_points = 20
         coords = np.random.rand(n_points, 2) * 100
         
-        # Compute distance matrix
-        distances = np.zeros((n_points, n_points))
-        for i in range(n_points):
-            for j in range(n_points):
-                distances[i, j] = np.sqrt(np.sum((coords[i] - coords[j])**2))
-        
+        # Compute distance matrix in one broadcast instead of n^2 tiny calls
+        distances = np.linalg.norm(coords[:, None, :] - coords[None, :, :], axis=-1)
+
         # Simple optimization
         best_cost = float('inf')
         for _ in range(100):
             perm = np.random.permutation(n_points)
-            cost = sum(distances[perm[i], perm[(i+1)%n_points]] for i in range(n_points))
+            cost = float(distances[perm, np.roll(perm, -1)].sum())
             best_cost = min(best_cost, cost)
             
         results["classical_computation"] = {
@@ -1,150 +1,271 @@
-from __future__ import annotations
-
-from typing import Dict, List, Tuple
-
-import pandas as pd
-
-from vrp_data import Vehicle, Depot, haversine_km
-
-
-def compute_depot_for_vehicle(veh: Vehicle, depots: Dict[str, Depot]) -> Depot:
-    if veh.current_location not in depots:
-        return list(depots.values())[0]
-    return depots[veh.current_location]
-
-
-def estimate_total_distance_km(
-    assignments: Dict[str, List[str]],
-    vehicles: Dict[str, Vehicle],
-    depots: Dict[str, Depot],
-    loc_df: pd.DataFrame,
-) -> Dict[str, float]:
-    by_loc = {r.location_id: r for r in loc_df.itertuples(index=False)}
-    total: Dict[str, float] = {}
-    for vid, locs in assignments.items():
-        dep = compute_depot_for_vehicle(vehicles[vid], depots)
-        s = 0.0
-        for lid in locs:
-            r = by_loc[lid]
-            s += haversine_km(dep.lat, dep.lon, float(r.lat), float(r.lon))
-        total[vid] = s
-    return total
-
-
-def enforce_constraints(
-    assignments: Dict[str, List[str]],
-    ranking_by_loc: Dict[str, List[str]],
-    vehicles: Dict[str, Vehicle],
-    depots: Dict[str, Depot],
-    loc_df: pd.DataFrame,
-    constraints: Dict,
-) -> Tuple[Dict[str, List[str]], List[str]]:
-    import time
-    start_time = time.time()
-    TIMEOUT_SECONDS = 5  # Maximum time to spend in constraint enforcement
-
-    max_stops = int(constraints.get("max_stops_per_vehicle", 1_000_000))
-    max_dist = float(constraints.get("max_distance_per_vehicle", 1e12))
-    max_time = float(constraints.get("max_time_per_vehicle", 1e12))  # hours
-    priority_handling = bool(constraints.get("priority_handling", True))
-
-    veh_caps = {vid: vehicles[vid].capacity for vid in vehicles}
-    veh_types = {vid: vehicles[vid].type for vid in vehicles}
-    allowed_types = set(constraints.get("allowed_vehicle_types", ["small", "medium", "large"]))
-    allowed_vehicles = [vid for vid in vehicles if veh_types[vid] in allowed_types]
-
-    demand_by_loc = {r.location_id: float(r.demand) for r in loc_df.itertuples(index=False)}
-    prio_by_loc = {r.location_id: int(r.priority) for r in loc_df.itertuples(index=False)}
-
-    for vid in list(assignments.keys()):
-        if vid not in allowed_vehicles:
-            for lid in assignments[vid]:
-                choices = [v for v in ranking_by_loc[lid] if v in allowed_vehicles]
-                if not choices:
-                    continue
-                target = choices[0]
-                assignments.setdefault(target, []).append(lid)
-            assignments[vid] = []
-
-    for vid in allowed_vehicles:
-        locs = assignments.get(vid, [])
-        if not locs:
-            continue
-        if priority_handling:
-            locs.sort(key=lambda lid: prio_by_loc[lid])
-        if len(locs) > max_stops:
-            overflow = locs[max_stops:]
-            assignments[vid] = locs[:max_stops]
-            for lid in overflow:
-                for alt in ranking_by_loc[lid]:
-                    if alt == vid:
-                        continue
-                    if alt not in allowed_vehicles:
-                        continue
-                    assignments.setdefault(alt, []).append(lid)
-                    break
-
-    changed = True
-    while changed and (time.time() - start_time) < TIMEOUT_SECONDS:
-        changed = False
-        for vid in allowed_vehicles:
-            locs = assignments.get(vid, [])
-            cap = veh_caps[vid]
-            total_demand = sum(demand_by_loc[lid] for lid in locs)
-            if total_demand <= cap + 1e-6:
-                continue
-            locs_sorted = sorted(locs, key=lambda lid: (prio_by_loc[lid], -demand_by_loc[lid]), reverse=True)
-            for lid in locs_sorted:
-                locs.remove(lid)
-                for alt in ranking_by_loc[lid]:
-                    if alt == vid or alt not in allowed_vehicles:
-                        continue
-                    assignments.setdefault(alt, []).append(lid)
-                    break
-            assignments[vid] = locs
-            changed = True
-
-    AVG_SPEED_KMPH = 30.0
-    change_loop = True
-    while change_loop and (time.time() - start_time) < TIMEOUT_SECONDS:
-        change_loop = False
-        total_dist = estimate_total_distance_km(assignments, vehicles, depots, loc_df)
-        for vid in allowed_vehicles:
-            dist = total_dist.get(vid, 0.0)
-            time_est = dist / AVG_SPEED_KMPH
-            if dist <= max_dist + 1e-6 and time_est <= max_time + 1e-6:
-                continue
-            locs = assignments.get(vid, [])
-            if not locs:
-                continue
-            locs_sorted = sorted(locs, key=lambda lid: prio_by_loc[lid], reverse=True)
-            removed_any = False
-            for lid in locs_sorted:
-                if lid not in locs:
-                    continue
-                locs.remove(lid)
-                for alt in ranking_by_loc[lid]:
-                    if alt == vid or alt not in allowed_vehicles:
-                        continue
-                    assignments.setdefault(alt, []).append(lid)
-                    break
-                removed_any = True
-                total_dist = estimate_total_distance_km(assignments, vehicles, depots, loc_df)
-                dist = total_dist.get(vid, 0.0)
-                time_est = dist / AVG_SPEED_KMPH
-                if dist <= max_dist + 1e-6 and time_est <= max_time + 1e-6:
-                    break
-            assignments[vid] = locs
-            if removed_any:
-                change_loop = True
-
-    # If we hit timeout, ensure we return valid assignments
-    if (time.time() - start_time) >= TIMEOUT_SECONDS:
-        print("Warning: Constraint enforcement timed out after 30 seconds")
-
-    assigned_set = {lid for locs in assignments.values() for lid in locs}
-    all_locs = set(loc_df["location_id"].tolist())
-    unassigned = sorted(list(all_locs - assigned_set))
-
-    return assignments, unassigned
-
+from __future__ import annotations
+
+import heapq
+import itertools
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from vrp_data import Vehicle, Depot
+
+
+def compute_depot_for_vehicle(veh: Vehicle, depots: Dict[str, Depot]) -> Depot:
+    if veh.current_location not in depots:
+        return next(iter(depots.values()))
+    return depots[veh.current_location]
+
+
+@dataclass
+class PrecomputedGeo:
+    """Radian coordinate arrays and lookups shared across constraint passes.
+
+    Building these costs one pass over the DataFrame; callers that invoke
+    estimate_total_distance_km repeatedly should build once and pass through.
+    """
+    lat_rad: np.ndarray
+    lon_rad: np.ndarray
+    loc_idx: Dict[str, int]
+    depot_rad_by_vid: Dict[str, Tuple[float, float]]
+
+    @classmethod
+    def build(cls, vehicles: Dict[str, Vehicle], depots: Dict[str, Depot], loc_df: pd.DataFrame) -> "PrecomputedGeo":
+        depot_rad_by_vid = {}
+        for vid, veh in vehicles.items():
+            dep = compute_depot_for_vehicle(veh, depots)
+            depot_rad_by_vid[vid] = (math.radians(dep.lat), math.radians(dep.lon))
+        return cls(
+            lat_rad=np.radians(loc_df["lat"].to_numpy(np.float64)),
+            lon_rad=np.radians(loc_df["lon"].to_numpy(np.float64)),
+            loc_idx={lid: i for i, lid in enumerate(loc_df["location_id"])},
+            depot_rad_by_vid=depot_rad_by_vid,
+        )
+
+
+def estimate_total_distance_km(
+    assignments: Dict[str, List[str]],
+    vehicles: Dict[str, Vehicle],
+    depots: Dict[str, Depot],
+    loc_df: pd.DataFrame,
+    geo: Optional[PrecomputedGeo] = None,
+) -> Dict[str, float]:
+    # One vectorized haversine per vehicle over its assigned slice instead of
+    # a scalar trig call per stop; this runs inside the constraint fix-point
+    # loops so the per-call Python overhead adds up quickly.
+    if geo is None:
+        geo = PrecomputedGeo.build(vehicles, depots, loc_df)
+    lat_rad, lon_rad, loc_idx = geo.lat_rad, geo.lon_rad, geo.loc_idx
+    R = 6371.0
+
+    total: Dict[str, float] = {}
+    for vid, locs in assignments.items():
+        if not locs:
+            total[vid] = 0.0
+            continue
+        lat1, lon1 = geo.depot_rad_by_vid[vid]
+        idx = np.fromiter((loc_idx[lid] for lid in locs), dtype=np.intp, count=len(locs))
+        dlat = lat_rad[idx] - lat1
+        dlon = lon_rad[idx] - lon1
+        a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat_rad[idx]) * np.sin(dlon / 2) ** 2
+        total[vid] = float((2.0 * R * np.arcsin(np.sqrt(a))).sum())
+    return total
+
+
+def enforce_constraints(
+    assignments: Dict[str, List[str]],
+    ranking_by_loc: Dict[str, List[str]],
+    vehicles: Dict[str, Vehicle],
+    depots: Dict[str, Depot],
+    loc_df: pd.DataFrame,
+    constraints: Dict,
+    geo: Optional[PrecomputedGeo] = None,
+) -> Tuple[Dict[str, List[str]], List[str]]:
+    import time
+    TIMEOUT_SECONDS = 5  # Maximum time to spend in constraint enforcement
+    # Monotonic deadline: immune to wall-clock adjustments (NTP steps)
+    deadline = time.monotonic() + TIMEOUT_SECONDS
+
+    if geo is None:
+        geo = PrecomputedGeo.build(vehicles, depots, loc_df)
+
+    max_stops = int(constraints.get("max_stops_per_vehicle", 1_000_000))
+    max_dist = float(constraints.get("max_distance_per_vehicle", 1e12))
+    max_time = float(constraints.get("max_time_per_vehicle", 1e12))  # hours
+    priority_handling = bool(constraints.get("priority_handling", True))
+
+    veh_caps = {vid: vehicles[vid].capacity for vid in vehicles}
+    veh_types = {vid: vehicles[vid].type for vid in vehicles}
+    allowed_types = set(constraints.get("allowed_vehicle_types", ["small", "medium", "large"]))
+    allowed_vehicles = [vid for vid in vehicles if veh_types[vid] in allowed_types]
+    # Set twin for membership tests: the list preserves iteration order, the
+    # set turns the O(V) `in` scans inside the reassignment loops into O(1)
+    allowed_vehicles_set = set(allowed_vehicles)
+
+    # Track the set of assigned locations incrementally: dropped stops are
+    # discarded at the point of loss, so no full rescan is needed at the end
+    assigned = set(itertools.chain.from_iterable(assignments.values()))
+
+    # Int-indexed NumPy columns replace the per-string demand/priority dicts;
+    # every lookup below goes through the shared location index once
+    loc_idx = geo.loc_idx
+    demand_arr = loc_df["demand"].to_numpy(np.float64)
+    prio_arr = loc_df["priority"].to_numpy(np.int64)
+
+    AVG_SPEED_KMPH = 30.0
+
+    # Dense vehicle x location depot-distance matrix built once; the
+    # feasibility check and the incremental repair bookkeeping below both
+    # read from it, so no per-stop haversine calls remain in the loops.
+    vid_list = list(vehicles.keys())
+    vid_idx = {vid: j for j, vid in enumerate(vid_list)}
+    lat_rad = geo.lat_rad
+    lon_rad = geo.lon_rad
+    dep_lat = np.array([geo.depot_rad_by_vid[vid][0] for vid in vid_list])
+    dep_lon = np.array([geo.depot_rad_by_vid[vid][1] for vid in vid_list])
+    a = (np.sin((lat_rad[None, :] - dep_lat[:, None]) / 2) ** 2
+         + np.cos(dep_lat[:, None]) * np.cos(lat_rad[None, :])
+         * np.sin((lon_rad[None, :] - dep_lon[:, None]) / 2) ** 2)
+    D = 2.0 * 6371.0 * np.arcsin(np.sqrt(a))
+
+    # Early exit: generated benchmarks often arrive already feasible, in
+    # which case every repair pass below is a no-op. One vectorized check
+    # per vehicle lets us skip straight to the return.
+    feasible = True
+    for vid, locs in assignments.items():
+        if not locs:
+            continue
+        if vid not in allowed_vehicles_set or len(locs) > max_stops:
+            feasible = False
+            break
+        idx = np.fromiter((loc_idx[lid] for lid in locs), dtype=np.intp, count=len(locs))
+        dist = float(D[vid_idx[vid], idx].sum())
+        if (demand_arr[idx].sum() > veh_caps[vid] + 1e-6
+                or dist > max_dist + 1e-6
+                or dist / AVG_SPEED_KMPH > max_time + 1e-6):
+            feasible = False
+            break
+    if feasible:
+        print("Constraint enforcement: input already feasible, repair skipped")
+        if priority_handling:
+            for locs in assignments.values():
+                locs.sort(key=lambda lid: prio_arr[loc_idx[lid]])
+        all_locs = set(loc_df["location_id"].tolist())
+        return assignments, sorted(all_locs - assigned)
+
+    for vid in list(assignments.keys()):
+        if vid not in allowed_vehicles_set:
+            for lid in assignments[vid]:
+                choices = [v for v in ranking_by_loc[lid] if v in allowed_vehicles_set]
+                if not choices:
+                    assigned.discard(lid)
+                    continue
+                target = choices[0]
+                assignments.setdefault(target, []).append(lid)
+            assignments[vid] = []
+
+    for vid in allowed_vehicles:
+        locs = assignments.get(vid, [])
+        if not locs:
+            continue
+        if priority_handling:
+            locs.sort(key=lambda lid: prio_arr[loc_idx[lid]])
+        if len(locs) > max_stops:
+            overflow = locs[max_stops:]
+            assignments[vid] = locs[:max_stops]
+            for lid in overflow:
+                for alt in ranking_by_loc[lid]:
+                    if alt == vid:
+                        continue
+                    if alt not in allowed_vehicles_set:
+                        continue
+                    assignments.setdefault(alt, []).append(lid)
+                    break
+                else:
+                    assigned.discard(lid)
+
+    # The repair loops below remove and reinsert many individual locations;
+    # insertion-ordered dicts give O(1) removal and membership where
+    # list.remove was a linear scan per move.
+    assignments = {vid: dict.fromkeys(locs) for vid, locs in assignments.items()}
+
+    # Per-vehicle totals are maintained incrementally on every move instead
+    # of re-estimating all route distances after each removal.
+    running_dist = {
+        vid: float(sum(D[vid_idx[vid], loc_idx[lid]] for lid in assignments.get(vid, [])))
+        for vid in vid_list
+    }
+    used_cap = {
+        vid: float(demand_arr[[loc_idx[lid] for lid in assignments.get(vid, {})]].sum())
+        for vid in allowed_vehicles
+    }
+
+    def _violation(vid: str) -> float:
+        """Normalized total violation across capacity, distance and time."""
+        over_cap = max(0.0, used_cap.get(vid, 0.0) - veh_caps[vid]) / max(veh_caps[vid], 1e-9)
+        dist = running_dist.get(vid, 0.0)
+        over_dist = max(0.0, dist - max_dist) / max(max_dist, 1e-9)
+        over_time = max(0.0, dist / AVG_SPEED_KMPH - max_time) / max(max_time, 1e-9)
+        return over_cap + over_dist + over_time
+
+    def _fits(vid: str, demand: float, leg: float) -> bool:
+        """Would vehicle vid stay feasible after accepting this stop?"""
+        if used_cap.get(vid, 0.0) + demand > veh_caps[vid] + 1e-6:
+            return False
+        dist = running_dist.get(vid, 0.0) + leg
+        return dist <= max_dist + 1e-6 and dist / AVG_SPEED_KMPH <= max_time + 1e-6
+
+    # Unified feasibility repair: one max-violation heap covering capacity,
+    # distance and time jointly. Each popped vehicle donates its
+    # lowest-priority stops to ranked alternatives that stay feasible
+    # (tracked incrementally), so no donation creates new violations and no
+    # fix-point iteration is needed. Stops that cannot be rehomed are dropped
+    # only when the vehicle exceeds its distance/time budget.
+    repair_heap = [(-_violation(vid), vid) for vid in allowed_vehicles if _violation(vid) > 0.0]
+    heapq.heapify(repair_heap)
+    while repair_heap and time.monotonic() < deadline:
+        _, vid = heapq.heappop(repair_heap)
+        if _violation(vid) <= 0.0:
+            continue
+        locs = assignments.get(vid, {})
+        for lid in sorted(locs, key=lambda l: (prio_arr[loc_idx[l]], -demand_arr[loc_idx[l]]), reverse=True):
+            if lid not in locs:
+                continue
+            demand = float(demand_arr[loc_idx[lid]])
+            for alt in ranking_by_loc[lid]:
+                if alt == vid or alt not in allowed_vehicles_set:
+                    continue
+                if not _fits(alt, demand, float(D[vid_idx[alt], loc_idx[lid]])):
+                    continue
+                del locs[lid]
+                assignments.setdefault(alt, {})[lid] = None
+                used_cap[vid] -= demand
+                used_cap[alt] = used_cap.get(alt, 0.0) + demand
+                running_dist[vid] -= float(D[vid_idx[vid], loc_idx[lid]])
+                running_dist[alt] = running_dist.get(alt, 0.0) + float(D[vid_idx[alt], loc_idx[lid]])
+                break
+            else:
+                # No feasible acceptor: shed the stop only to honour a hard
+                # distance/time budget (the pre-merge distance loop did this)
+                dist = running_dist.get(vid, 0.0)
+                if dist > max_dist + 1e-6 or dist / AVG_SPEED_KMPH > max_time + 1e-6:
+                    del locs[lid]
+                    used_cap[vid] -= demand
+                    running_dist[vid] -= float(D[vid_idx[vid], loc_idx[lid]])
+                    assigned.discard(lid)
+            if _violation(vid) <= 0.0:
+                break
+
+    # If we hit timeout, ensure we return valid assignments
+    if time.monotonic() >= deadline:
+        print(f"Warning: Constraint enforcement timed out after {TIMEOUT_SECONDS} seconds")
+
+    # Convert the internal ordered-dict containers back to lists for callers
+    assignments = {vid: list(locs) for vid, locs in assignments.items()}
+
+    all_locs = set(loc_df["location_id"].tolist())
+    unassigned = sorted(all_locs - assigned)
+
+    return assignments, unassigned
+
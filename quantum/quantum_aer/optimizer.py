@@ -1,45 +1,34 @@
 from __future__ import annotations
-from typing import Any, Dict, Optional, List
+from typing import Any, Dict, Optional, List, Tuple
 import numpy as np
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pickle
 import time
 
 # Import your existing modules
-from vrp_data import load_data, preprocess_to_features, haversine_km
-from constraints_layer import enforce_constraints, compute_depot_for_vehicle, estimate_total_distance_km
-from qaoa_assign import run_qaoa_assignment  
+from vrp_data import load_data, preprocess_to_features, haversine_km_batch
+from constraints_layer import enforce_constraints, estimate_total_distance_km, PrecomputedGeo
+from qaoa_assign import run_qaoa_assignment, build_qaoa_ansatz
+
+# Memoized QAOA outputs keyed by quantized normalized-cost vectors. Clustered
+# datasets yield many near-identical rows, so duplicates become dict lookups
+# instead of fresh simulations. Per-process when running under a process pool.
+_QAOA_CACHE: Dict[tuple, tuple] = {}
+_QAOA_CACHE_MAX = 1024
+
+
+def _depot_cost_vector(lat: float, lon: float, dep_lats: np.ndarray, dep_lons: np.ndarray) -> np.ndarray:
+    """Distances (km) from one location to every vehicle's depot in one pass."""
+    return haversine_km_batch(lat, lon, dep_lats, dep_lons)
+
 
 def _process_location_qaoa(args) -> Tuple[str, Dict[str, int], List[str]]:
     """Process a single location with QAOA - for parallel execution."""
-    (lid, row_series, vehicle_ids, vehicles, depots, backend, 
-     shots, qaoa_p, qaoa_penalty, include_counts) = args
-    
+    (lid, vehicle_ids, costs, costs_norm, backend,
+     shots, qaoa_p, qaoa_penalty, include_counts, template) = args
+
     try:
-        # Build costs efficiently
-        costs = []
-        for vid in vehicle_ids:
-            veh = vehicles[vid]
-            if veh.current_location in depots:
-                dep = depots[veh.current_location]
-            else:
-                dep = list(depots.values())[0]
-            
-            dkm = haversine_km(
-                float(row_series["lat"]), float(row_series["lon"]), 
-                dep.lat, dep.lon
-            )
-            costs.append(dkm)
-        
-        costs = np.array(costs, dtype=float)
-        
-        # Normalize costs for stability
-        cmin, cmax = float(costs.min()), float(costs.max())
-        if cmax - cmin > 1e-9:
-            costs_norm = (costs - cmin) / (cmax - cmin)
-        else:
-            costs_norm = np.zeros_like(costs)
-        
         # Use smaller grid for speed
         if len(costs) <= 3:
             grid_vals = [0.3, 0.7]
@@ -49,22 +38,40 @@ def _process_location_qaoa(args) -> Tuple[str, Dict[str, int], List[str]]:
         
         # Run QAOA with reduced shots for speed
         adaptive_shots = min(shots, max(300, shots // 2))
-        counts_idx, best_pair = run_qaoa_assignment(
-            costs=costs_norm, 
-            backend=backend,
-            shots=adaptive_shots, 
-            p=qaoa_p, 
-            A=qaoa_penalty, 
-            grid=grid
-        )
+
+        # Quantize the normalized costs to 1% resolution for the cache key;
+        # rows that agree at that resolution reuse the previous result
+        key = (tuple(np.round(costs_norm * 100).astype(int).tolist()),
+               qaoa_p, adaptive_shots, qaoa_penalty)
+        cached = _QAOA_CACHE.get(key)
+        if cached is not None:
+            counts_idx, best_pair = cached
+        else:
+            counts_idx, best_pair = run_qaoa_assignment(
+                costs=costs_norm,
+                backend=backend,
+                shots=adaptive_shots,
+                p=qaoa_p,
+                A=qaoa_penalty,
+                grid=grid,
+                template=template
+            )
+            if len(_QAOA_CACHE) >= _QAOA_CACHE_MAX:
+                _QAOA_CACHE.pop(next(iter(_QAOA_CACHE)))
+            _QAOA_CACHE[key] = (counts_idx, best_pair)
         
-        # Create ranking
+        # Create ranking: scatter the sparse counts into a dense vector and
+        # let one stable argsort order vehicles, instead of a Python sort
+        # with a dict-lookup key per comparison
         if counts_idx:
-            order_idx = sorted(range(len(vehicle_ids)), 
-                             key=lambda i: counts_idx.get(i, 0), reverse=True)
+            tally = np.zeros(len(vehicle_ids), dtype=np.int64)
+            for i, c in counts_idx.items():
+                if i < len(vehicle_ids):
+                    tally[i] = c
+            order_idx = np.argsort(-tally, kind="stable")
         else:
-            order_idx = sorted(range(len(vehicle_ids)), key=lambda i: costs[i])
-        
+            order_idx = np.argsort(costs, kind="stable")
+
         ranking = [vehicle_ids[i] for i in order_idx]
         
         # Prepare counts for return
@@ -78,18 +85,7 @@ def _process_location_qaoa(args) -> Tuple[str, Dict[str, int], List[str]]:
     except Exception as e:
         print(f"Error processing location {lid}: {e}")
         # Fallback to distance-based ranking
-        costs = []
-        for vid in vehicle_ids:
-            veh = vehicles[vid]
-            dep = depots.get(veh.current_location, list(depots.values())[0])
-            dkm = haversine_km(
-                float(row_series["lat"]), float(row_series["lon"]), 
-                dep.lat, dep.lon
-            )
-            costs.append(dkm)
-        
-        order_idx = sorted(range(len(vehicle_ids)), key=lambda i: costs[i])
-        ranking = [vehicle_ids[i] for i in order_idx]
+        ranking = [vehicle_ids[i] for i in np.argsort(costs)]
         return lid, {}, ranking
 
 def optimize_vrp(raw: Dict, shots: int = 1000, include_counts: bool = True, method: str = "qaoa",
@@ -107,6 +103,13 @@ def optimize_vrp(raw: Dict, shots: int = 1000, include_counts: bool = True, meth
         num_trucks = len(vehicles)
         vehicle_ids = list(vehicles.keys())
 
+        # Depot coordinates aligned to vehicle_ids, for the vectorized
+        # haversine cost builds below and in the workers
+        default_depot = next(iter(depots.values()))
+        vid_to_depot = {vid: depots.get(vehicles[vid].current_location, default_depot) for vid in vehicle_ids}
+        dep_lats = np.array([vid_to_depot[vid].lat for vid in vehicle_ids])
+        dep_lons = np.array([vid_to_depot[vid].lon for vid in vehicle_ids])
+
         print(f"\n=== OPTIMIZED VRP OPTIMIZATION ===")
         print(f"Method: {method}, Vehicles: {num_trucks}, Locations: {len(loc_df)}")
 
@@ -125,30 +128,61 @@ def optimize_vrp(raw: Dict, shots: int = 1000, include_counts: bool = True, meth
         counts_by_loc_id: Dict[str, Dict[str, int]] = {}
         ranking_by_loc_id: Dict[str, List[str]] = {}
 
-        def tuple_to_series(t):
-            """Convert namedtuple to pandas Series."""
-            if hasattr(t, "_asdict"):
-                d = t._asdict()
-            else:
-                fields = getattr(t, "_fields", [])
-                d = {name: getattr(t, name) for name in fields}
-            return pd.Series(d)
+        # Location ids pulled out once; the loops below only need the id and
+        # a row index, so per-row itertuples namedtuples are avoided entirely
+        loc_ids = [str(x) for x in loc_df["location_id"].to_numpy()]
 
         if method == "qaoa" and backend is not None:
             print(f"Processing {len(loc_df)} locations in parallel...")
-            
+
+            # Fuse every location's depot-cost vector into one (L, K) matrix
+            # and normalize all rows in a single vectorized pass; workers
+            # receive their precomputed rows instead of rebuilding them.
+            lat1 = np.radians(loc_df["lat"].to_numpy(np.float64))[:, None]
+            lon1 = np.radians(loc_df["lon"].to_numpy(np.float64))[:, None]
+            lat2 = np.radians(dep_lats)[None, :]
+            lon2 = np.radians(dep_lons)[None, :]
+            a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+            all_costs = 2.0 * 6371.0 * np.arcsin(np.sqrt(a))
+            span = np.ptp(all_costs, axis=1, keepdims=True)
+            span[span < 1e-9] = 1.0  # degenerate rows normalize to zeros
+            all_norm = (all_costs - all_costs.min(axis=1, keepdims=True)) / span
+
+            # Build and transpile the parameterized ansatz once; workers only
+            # bind angles per grid point, removing transpilation from the
+            # per-location hot path. The single-layer template matches the
+            # p=1 fast path used inside run_qaoa_assignment.
+            template = None
+            try:
+                from qiskit import transpile
+                circ, tparams = build_qaoa_ansatz(num_trucks, p=1)
+                if hasattr(backend, 'run'):
+                    circ = transpile(circ, backend, optimization_level=1)
+                template = (circ, tparams)
+            except Exception as e:
+                print(f"Ansatz precompilation failed, workers will build circuits: {e}")
+
             # Prepare arguments for parallel processing
             args_list = []
-            for _, row in enumerate(loc_df.itertuples(index=False)):
-                lid = str(row.location_id)
-                row_series = tuple_to_series(row)
-                args = (lid, row_series, vehicle_ids, vehicles, depots, backend,
-                       adaptive_shots, qaoa_p, qaoa_penalty, include_counts)
+            for i, lid in enumerate(loc_ids):
+                args = (lid, vehicle_ids, all_costs[i], all_norm[i], backend,
+                       adaptive_shots, qaoa_p, qaoa_penalty, include_counts, template)
                 args_list.append(args)
             
+            # Per-location QAOA is CPU-bound Python (circuit build, NumPy,
+            # classical post-processing), so prefer a process pool to escape
+            # the GIL; threads remain the fallback when the backend handle
+            # cannot cross a process boundary.
+            executor_cls = ProcessPoolExecutor
+            try:
+                pickle.dumps(backend)
+            except Exception:
+                print("Backend not picklable, using thread-based parallelism")
+                executor_cls = ThreadPoolExecutor
+
             # Process locations in parallel with timeout
             try:
-                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                with executor_cls(max_workers=max_workers) as executor:
                     futures = [executor.submit(_process_location_qaoa, args) for args in args_list]
                     
                     for i, future in enumerate(futures):
@@ -166,79 +200,46 @@ def optimize_vrp(raw: Dict, shots: int = 1000, include_counts: bool = True, meth
                             print(f"Location processing timeout/error: {e}")
                             # Use distance-based fallback
                             lid = args_list[i][0]
-                            row_series = args_list[i][1]
-                            
-                            costs = []
-                            for vid in vehicle_ids:
-                                veh = vehicles[vid]
-                                dep = depots.get(veh.current_location, list(depots.values())[0])
-                                dkm = haversine_km(
-                                    float(row_series["lat"]), float(row_series["lon"]), 
-                                    dep.lat, dep.lon
-                                )
-                                costs.append(dkm)
-                            
-                            order_idx = sorted(range(len(vehicle_ids)), key=lambda i: costs[i])
-                            ranking_by_loc_id[lid] = [vehicle_ids[i] for i in order_idx]
+                            costs = args_list[i][2]
+                            ranking_by_loc_id[lid] = [vehicle_ids[j] for j in np.argsort(costs)]
                             
             except Exception as e:
                 print(f"Parallel processing failed: {e}, falling back to sequential")
                 # Sequential fallback with reduced parameters
-                for i, row in enumerate(loc_df.itertuples(index=False)):
-                    lid = str(row.location_id)
-                    row_series = tuple_to_series(row)
-                    
+                for i, lid in enumerate(loc_ids):
                     try:
-                        args = (lid, row_series, vehicle_ids, vehicles, depots, backend,
-                               adaptive_shots // 2, qaoa_p, qaoa_penalty, include_counts)
+                        args = (lid, vehicle_ids, all_costs[i], all_norm[i], backend,
+                               adaptive_shots // 2, qaoa_p, qaoa_penalty, include_counts, template)
                         lid, counts_result, ranking = _process_location_qaoa(args)
-                        
+
                         if include_counts and counts_result:
                             counts_by_loc_id[lid] = counts_result
                         ranking_by_loc_id[lid] = ranking
-                        
+
                     except Exception as loc_error:
                         print(f"Failed to process location {lid}: {loc_error}")
                         # Ultimate fallback - distance-based ranking
-                        costs = []
-                        for vid in vehicle_ids:
-                            veh = vehicles[vid]
-                            dep = depots.get(veh.current_location, list(depots.values())[0])
-                            dkm = haversine_km(
-                                float(row_series["lat"]), float(row_series["lon"]), 
-                                dep.lat, dep.lon
-                            )
-                            costs.append(dkm)
-                        
-                        order_idx = sorted(range(len(vehicle_ids)), key=lambda i: costs[i])
-                        ranking_by_loc_id[lid] = [vehicle_ids[i] for i in order_idx]
+                        ranking_by_loc_id[lid] = [vehicle_ids[j] for j in np.argsort(all_costs[i])]
 
         else:
             # Default PQC method or classical fallback
             print("Using classical/PQC method...")
-            for i, row in enumerate(loc_df.itertuples(index=False)):
-                lid = str(row.location_id)
-                row_series = tuple_to_series(row)
-                
+            loc_lats = loc_df["lat"].to_numpy(np.float64)
+            loc_lons = loc_df["lon"].to_numpy(np.float64)
+            records = loc_df.to_dict("records") if method != "qaoa" else None
+            for i, lid in enumerate(loc_ids):
                 if method == "qaoa":
                     # Classical distance-based assignment when no backend
-                    costs = []
-                    for vid in vehicle_ids:
-                        veh = vehicles[vid]
-                        dep = depots.get(veh.current_location, list(depots.values())[0])
-                        dkm = haversine_km(
-                            float(row_series["lat"]), float(row_series["lon"]), 
-                            dep.lat, dep.lon
-                        )
-                        costs.append(dkm)
-                    
-                    order_idx = sorted(range(len(vehicle_ids)), key=lambda i: costs[i])
-                    ranking_by_loc_id[lid] = [vehicle_ids[i] for i in order_idx]
-                    
+                    costs = _depot_cost_vector(
+                        loc_lats[i], loc_lons[i], dep_lats, dep_lons
+                    )
+                    ranking_by_loc_id[lid] = [vehicle_ids[j] for j in np.argsort(costs)]
+
                 else:
-                    # Original PQC method
+                    # Original PQC method; plain dict access replaces the
+                    # per-row pandas Series wrapper
                     circuit, _ = build_assignment_circuit_for_location(
-                        row_series, num_trucks=num_trucks, measure_key="assign"
+                        records[i], num_trucks=num_trucks, measure_key="assign"
                     )
                     counts_idx = simulate_counts(
                         circuit, key="assign", num_trucks=num_trucks, shots=adaptive_shots
@@ -263,20 +264,30 @@ def optimize_vrp(raw: Dict, shots: int = 1000, include_counts: bool = True, meth
             assignments[best_vid].append(lid)
 
         print("Enforcing constraints...")
+        geo = PrecomputedGeo.build(vehicles, depots, loc_df)
         assignments, unassigned = enforce_constraints(
-            assignments, ranking_by_loc_id, vehicles, depots, loc_df, 
-            data.get("constraints", {})
+            assignments, ranking_by_loc_id, vehicles, depots, loc_df,
+            data.get("constraints", {}), geo=geo
         )
 
-        # Build result summary efficiently
-        by_loc = {r.location_id: r for r in loc_df.itertuples(index=False)}
+        # Build result summary with one vectorized demand aggregation instead
+        # of a Python sum of dict lookups per vehicle
+        pairs = [(vid, lid) for vid, locs in assignments.items() for lid in locs]
+        if pairs:
+            pair_df = pd.DataFrame(pairs, columns=["vid", "location_id"]).merge(
+                loc_df[["location_id", "demand"]], on="location_id"
+            )
+            demand_sum = pair_df.groupby("vid")["demand"].sum().to_dict()
+        else:
+            demand_sum = {}
+
         per_vehicle_summary: Dict[str, Dict[str, Any]] = {}
-        
+
         for vid, locs in assignments.items():
             veh = vehicles[vid]
-            depot = compute_depot_for_vehicle(veh, depots)
-            total_demand = sum(float(by_loc[lid].demand) for lid in locs)
-            
+            depot = vid_to_depot[vid]
+            total_demand = float(demand_sum.get(vid, 0.0))
+
             per_vehicle_summary[vid] = {
                 "vehicle_type": veh.type,
                 "capacity": veh.capacity,
@@ -291,7 +302,7 @@ def optimize_vrp(raw: Dict, shots: int = 1000, include_counts: bool = True, meth
             }
 
         # Compute distances
-        distance_map = estimate_total_distance_km(assignments, vehicles, depots, loc_df)
+        distance_map = estimate_total_distance_km(assignments, vehicles, depots, loc_df, geo=geo)
         for vid in per_vehicle_summary:
             per_vehicle_summary[vid]["approx_distance_km"] = float(distance_map.get(vid, 0.0))
 
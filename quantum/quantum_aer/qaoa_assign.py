@@ -1,30 +1,140 @@
 from __future__ import annotations
 from typing import Dict, List, Tuple, Optional
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
+import os
 import time
 from functools import lru_cache
 
 from qiskit import QuantumCircuit
+from qiskit.circuit import Parameter, ParameterVector
 from qiskit_aer import AerSimulator
 from qiskit.transpiler.preset_passmanagers import generate_preset_pass_manager
+from qiskit.transpiler import PassManager
+from qiskit.transpiler.passes import CommutativeCancellation, Optimize1qGates
 
-# Global optimized simulator
-_OPTIMIZED_SIMULATOR = AerSimulator(
-    method='statevector',
-    max_parallel_threads=2,
-    shots=1024
-)
+# Cheap gate-fusion pass: merges successive RZ rotations that meet at layer
+# boundaries and cancels commuting pairs, shrinking multi-layer circuits
+# without a full preset-passmanager run.
+_GATE_FUSION_PM = PassManager([CommutativeCancellation(), Optimize1qGates()])
+
+# Optional: joblib process-parallelizes the transpile-heavy real-backend
+# path, where the GIL makes thread pools ineffective.
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
+
+# Optional: numba compiles the classical energy reduction, which for small
+# K beats even the NumPy matmul (BLAS launch overhead dominates there).
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _energy_kernel(X: np.ndarray, cnt: np.ndarray, costs: np.ndarray, A: float, shots: float) -> float:  # pragma: no cover
+        n, K = X.shape
+        tot = 0.0
+        for i in prange(n):
+            s = 0.0
+            row_sum = 0.0
+            for j in range(K):
+                row_sum += X[i, j]
+                s += X[i, j] * costs[j]
+            tot += cnt[i] * (s + A * (row_sum - 1.0) ** 2)
+        return tot / shots
+
+    try:
+        # Warm the JIT once at import so the first request does not pay it
+        _energy_kernel(np.zeros((1, 1)), np.ones(1), np.zeros(1), 1.0, 1.0)
+    except Exception:
+        pass
+else:
+    _energy_kernel = None
+
+# Preset pass managers cached per backend instance: construction alone
+# costs tens of milliseconds, and the pass set only depends on the target.
+_PM_CACHE: Dict[int, object] = {}
+
+
+def _pm_for(backend) -> object:
+    """Level-3 pass manager for a real backend, built once and reused.
+
+    Level 3 costs more up front but cuts two-qubit gate counts markedly on
+    QAOA-family circuits, and the cache amortizes it across grid points.
+    """
+    pm = _PM_CACHE.get(id(backend))
+    if pm is None:
+        pm = generate_preset_pass_manager(backend=backend, optimization_level=3)
+        _PM_CACHE[id(backend)] = pm
+    return pm
+
+
+def _fresh_simulator() -> AerSimulator:
+    """Stateless per-call simulator for the fallback path.
+
+    A shared module-level instance serialized concurrent API requests on
+    its internal thread pool; construction is cheap, and a single-threaded
+    inner simulator composes cleanly with outer process/batch parallelism.
+    """
+    return AerSimulator(
+        method='statevector',
+        precision='single',  # grid search tolerates float32; halves memory traffic
+        max_parallel_threads=1,
+        max_parallel_experiments=1,
+    )
 
 @lru_cache(maxsize=64)
-def _compute_h_coeffs(costs_tuple: tuple, A: float) -> Tuple[np.ndarray, float]:
-    """Cached computation of QUBO coefficients."""
-    costs = np.array(costs_tuple)
-    K = len(costs)
+def _h_coeffs_cached(costs_bytes: bytes, K: int, A: float) -> Tuple[np.ndarray, float]:
+    costs = np.frombuffer(costs_bytes, dtype=np.float64)
     h = -0.5 * (costs + A * (K - 2))
     J = A / 2.0
     return h, J
 
+def _compute_h_coeffs(costs: np.ndarray, A: float) -> Tuple[np.ndarray, float]:
+    """Cached computation of QUBO coefficients.
+
+    Keyed on the raw array bytes: one hashable allocation per call instead
+    of boxing K floats into a tuple on every circuit build.
+    """
+    costs = np.ascontiguousarray(costs, dtype=np.float64)
+    return _h_coeffs_cached(costs.tobytes(), len(costs), float(A))
+
+@lru_cache(maxsize=32)
+def _round_robin_pairs(K: int) -> Tuple[Tuple[int, int], ...]:
+    """All-to-all qubit pairs in circular-tournament order.
+
+    Consecutive pairs within a round touch disjoint qubits, so the RZZ
+    gates of each round commute into one parallel layer: depth drops from
+    O(K^2) for the naive nested-loop order to about K rounds.
+    """
+    players = list(range(K))
+    if K % 2:
+        players.append(-1)  # bye slot for odd K
+    n = len(players)
+    pairs: List[Tuple[int, int]] = []
+    for _ in range(n - 1):
+        for i in range(n // 2):
+            a, b = players[i], players[n - 1 - i]
+            if a != -1 and b != -1:
+                pairs.append((a, b))
+        players.insert(1, players.pop())
+    return tuple(pairs)
+
+def _coupling_pairs(K: int) -> Tuple[Tuple[int, int], ...]:
+    """RZZ pairs adapted to problem size.
+
+    Small fleets keep the capped round-robin all-to-all coupling; from 8
+    qubits up we fall back to a nearest-neighbour chain, which matches
+    linear hardware connectivity and keeps depth at O(K) where the full
+    coupling would drown the signal in noise on real devices.
+    """
+    if K >= 8:
+        return tuple((i, i + 1) for i in range(K - 1))
+    max_pairs = min(15, K * (K - 1) // 2)  # Limit complexity
+    return _round_robin_pairs(K)[:max_pairs]
+
 def _apply_cost_layer(circuit: QuantumCircuit, qubits: List[int], gamma: float, h: np.ndarray, J: float) -> None:
     """Optimized cost layer application."""
     # Skip very small rotations for speed
@@ -35,23 +145,65 @@ def _apply_cost_layer(circuit: QuantumCircuit, qubits: List[int], gamma: float,
         if abs(h[i]) > threshold:
             circuit.rz(2.0 * gamma * float(h[i]), qubits[i])
     
-    # Limit two-qubit interactions for larger problems
+    # Limit two-qubit interactions for larger problems; round-robin order
+    # keeps each round's gates on disjoint qubits so they run in parallel
     if len(qubits) >= 2 and abs(J) > threshold:
         exponent = 2.0 * gamma * float(J)
-        max_pairs = min(15, len(qubits) * (len(qubits) - 1) // 2)  # Limit complexity
-        count = 0
-        for i in range(len(qubits)):
-            for j in range(i + 1, len(qubits)):
-                if count >= max_pairs:
-                    break
-                circuit.rzz(exponent, qubits[i], qubits[j])
-                count += 1
+        for i, j in _coupling_pairs(len(qubits)):
+            circuit.rzz(exponent, qubits[i], qubits[j])
 
 def _apply_mixer_layer(circuit: QuantumCircuit, qubits: List[int], beta: float) -> None:
     """Apply the mixer layer to the circuit."""
     for i in qubits:
         circuit.rx(2.0 * beta, i)
 
+def build_qaoa_ansatz(K: int, p: int = 1) -> Tuple[QuantumCircuit, List[Tuple]]:
+    """Parameterized QAOA template: build (and transpile) once, bind per run.
+
+    The angle parameters absorb the cost coefficients, so a single template
+    serves every location of the same size K: each rz angle binds to
+    2*gamma*h[i], the shared rzz angle to 2*gamma*J and the mixer to 2*beta.
+    """
+    circuit = QuantumCircuit(K, K)
+    qubits = list(range(K))
+    circuit.h(qubits)
+
+    params: List[Tuple] = []
+    for layer in range(p):
+        th = ParameterVector(f"th{layer}", K)
+        ph = Parameter(f"ph{layer}")
+        bt = Parameter(f"bt{layer}")
+        for i in qubits:
+            circuit.rz(th[i], i)
+        if K >= 2:
+            for i, j in _coupling_pairs(K):  # Same coupling as the cost layer
+                circuit.rzz(ph, i, j)
+        for i in qubits:
+            circuit.rx(bt, i)
+        params.append((th, ph, bt))
+
+    circuit.measure(qubits, qubits)
+    return circuit, params
+
+@lru_cache(maxsize=16)
+def _cached_ansatz(K: int) -> Tuple[QuantumCircuit, Tuple]:
+    """One shared p=1 template per problem size; grid points only bind angles."""
+    circuit, params = build_qaoa_ansatz(K, p=1)
+    return circuit, tuple(params)
+
+def bind_qaoa_ansatz(template: QuantumCircuit, params: List[Tuple], costs: np.ndarray,
+                     gammas: List[float], betas: List[float], A: float = 2.0) -> QuantumCircuit:
+    """Bind concrete angles into a prebuilt (possibly transpiled) template."""
+    h, J = _compute_h_coeffs(costs, A)
+    binds = {}
+    for layer, (th, ph, bt) in enumerate(params):
+        g, b = gammas[layer], betas[layer]
+        for i in range(len(th)):
+            binds[th[i]] = 2.0 * g * float(h[i])
+        binds[ph] = 2.0 * g * float(J)
+        binds[bt] = 2.0 * b
+    return template.assign_parameters(binds)
+
 def build_qaoa_circuit_fast(costs: np.ndarray, gamma: float, beta: float, A: float = 2.0) -> QuantumCircuit:
     """Fast QAOA circuit construction for single parameter pair."""
     K = len(costs)
@@ -62,7 +214,7 @@ def build_qaoa_circuit_fast(costs: np.ndarray, gamma: float, beta: float, A: flo
     circuit.h(qubits)
     
     # Compute QUBO coefficients (cached)
-    h, J = _compute_h_coeffs(tuple(costs), A)
+    h, J = _compute_h_coeffs(costs, A)
     
     # Apply single layer (p=1 for speed)
     _apply_cost_layer(circuit, qubits, gamma, h, J)
@@ -83,51 +235,89 @@ def build_qaoa_circuit(costs: np.ndarray, gammas: List[float], betas: List[float
     circuit.h(qubits)  # Initialize uniform superposition
     
     # Compute QUBO coefficients (cached)
-    h, J = _compute_h_coeffs(tuple(costs), A)
+    h, J = _compute_h_coeffs(costs, A)
     
     # Apply p layers of QAOA
     for layer in range(p):
         _apply_cost_layer(circuit, qubits, gammas[layer], h, J)
         _apply_mixer_layer(circuit, qubits, betas[layer])
 
+    if p > 1:
+        # Fuse the RZ rotations meeting across layer boundaries; a single
+        # layer has nothing adjacent to merge so skip the pass overhead
+        circuit = _GATE_FUSION_PM.run(circuit)
+
     circuit.measure(qubits, qubits)
     return circuit, qubits
 
-def _bit_cost(bitstr: Tuple[int, ...], costs: np.ndarray, A: float) -> float:
-    """Compute the cost of a bit string."""
-    x = np.array(bitstr, dtype=float)
-    linear_cost = float(np.dot(costs, x))
-    constraint_penalty = A * (np.sum(x) - 1.0) ** 2
-    return linear_cost + constraint_penalty
+def _unpack_counts(counts: Dict[str, int], K: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode a counts dict into a (N, K) bit matrix and a weights vector.
+
+    Bit columns follow qubit order (Qiskit's little-endian keys reversed),
+    so row i of the matrix is the assignment pattern of outcome i.
+    """
+    vals = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+    buf = np.frombuffer("".join(counts).encode("ascii"), dtype=np.uint8).reshape(len(counts), K)
+    X = (buf[:, ::-1] - ord("0")).astype(np.float64)
+    return X, vals
+
+@lru_cache(maxsize=32)
+def _cost_table(costs_bytes: bytes, K: int, A: float) -> np.ndarray:
+    """Energy of every 2^K bit pattern, indexed by int(bitstring, 2).
+
+    Qiskit's little-endian keys already place qubit q at bit q of that
+    integer, so the table needs no per-outcome reversal.
+    """
+    costs = np.frombuffer(costs_bytes, dtype=np.float64)
+    bits = ((np.arange(1 << K)[:, None] >> np.arange(K)) & 1).astype(np.float64)
+    return bits @ costs + A * (bits.sum(axis=1) - 1.0) ** 2
 
 def _energy_from_counts(counts: Dict[str, int], costs: np.ndarray, A: float, shots: int) -> float:
     """Compute average energy from measurement counts."""
-    if shots <= 0:
+    if shots <= 0 or not counts:
         return 0.0
-    
-    total_energy = 0.0
-    for bitstr, count in counts.items():
-        bit_tuple = tuple(int(b) for b in bitstr[::-1])
-        cost = _bit_cost(bit_tuple, costs, A)
-        total_energy += cost * count
-    
-    return total_energy / float(shots)
+
+    K = len(costs)
+    vals = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+    if K <= 16:
+        # Grid points for the same costs reuse one precomputed 2^K energy
+        # table; each call is then a gather over integer outcome indices
+        E = _cost_table(np.ascontiguousarray(costs, dtype=np.float64).tobytes(), K, float(A))
+        idx = np.fromiter((int(b, 2) for b in counts), dtype=np.int64, count=len(counts))
+        return float((vals * E[idx]).sum() / shots)
+
+    # Large K: one bit-unpack, then either the compiled reduction or a
+    # matmul with the penalty term applied to all outcomes in one pass
+    X, _ = _unpack_counts(counts, K)
+    costs64 = np.ascontiguousarray(costs, dtype=np.float64)
+    if _energy_kernel is not None:
+        return float(_energy_kernel(X, vals, costs64, float(A), float(shots)))
+    energies = X @ costs64 + A * (X.sum(axis=1) - 1.0) ** 2
+    return float((vals * energies).sum() / shots)
 
 def _execute_single_parameter(args) -> Tuple[float, Dict[str, int], Tuple[float, float]]:
     """Execute QAOA for a single parameter pair - for parallel processing."""
-    gamma, beta, costs, A, shots, backend = args
-    
+    gamma, beta, costs, A, shots, backend, template = args
+
     try:
-        circuit = build_qaoa_circuit_fast(costs, gamma, beta, A)
-        
-        # Use optimized transpilation
-        if hasattr(backend, 'configuration'):
-            # Real backend
-            pm = generate_preset_pass_manager(backend=backend, optimization_level=1)
-            transpiled = pm.run(circuit)
+        if template is None and not hasattr(backend, 'configuration'):
+            # Simulator path needs no transpilation, so the shared per-K
+            # template applies even when the caller did not precompile one
+            template = _cached_ansatz(len(costs))
+        if template is not None:
+            # Prebuilt (already transpiled) ansatz: binding parameters is the
+            # only per-call circuit work left
+            transpiled = bind_qaoa_ansatz(template[0], template[1], costs, [gamma], [beta], A)
         else:
-            # Simulator - minimal transpilation
-            transpiled = circuit
+            circuit = build_qaoa_circuit_fast(costs, gamma, beta, A)
+
+            # Use optimized transpilation
+            if hasattr(backend, 'configuration'):
+                # Real backend
+                transpiled = _pm_for(backend).run(circuit)
+            else:
+                # Simulator - minimal transpilation
+                transpiled = circuit
         
         # Execute
         if hasattr(backend, 'run'):
@@ -146,53 +336,45 @@ def _execute_single_parameter(args) -> Tuple[float, Dict[str, int], Tuple[float,
         # Return high energy for failed executions
         return float('inf'), {}, (gamma, beta)
 
+@lru_cache(maxsize=32)
+def _onehot_patterns(K: int) -> Tuple[str, ...]:
+    """The K one-hot bitstrings of length K, built once per problem size."""
+    return tuple('0' * i + '1' + '0' * (K - i - 1) for i in range(K))
+
 def _simulate_fast(circuit: QuantumCircuit, shots: int) -> Dict[str, int]:
     """Fast simulation fallback."""
     try:
-        job = _OPTIMIZED_SIMULATOR.run(circuit, shots=shots)
+        job = _fresh_simulator().run(circuit, shots=shots)
         result = job.result()
         return result.get_counts()
     except:
         # Ultimate fallback - random counts
         K = circuit.num_qubits
-        counts = {}
+        pats = _onehot_patterns(K)
         best_idx = np.random.randint(K)
-        for i in range(K):
-            bitstr = '0' * K
-            bitstr = bitstr[:i] + '1' + bitstr[i+1:]
-            if i == best_idx:
-                counts[bitstr] = int(shots * 0.8)
-            else:
-                counts[bitstr] = int(shots * 0.2 / (K - 1))
-        return counts
+        return {pats[i]: int(shots * 0.8) if i == best_idx else int(shots * 0.2 / (K - 1))
+                for i in range(K)}
 
 def _classical_fallback(costs: np.ndarray, shots: int) -> Dict[str, int]:
     """Fast classical fallback when quantum execution fails."""
     min_idx = int(np.argmin(costs))
     K = len(costs)
-    counts = {}
-    
+    pats = _onehot_patterns(K)
+
     # Create distribution favoring minimum cost
-    for i in range(K):
-        bitstr = '0' * K
-        bitstr = bitstr[:i] + '1' + bitstr[i+1:]
-        
-        if i == min_idx:
-            counts[bitstr] = int(shots * 0.7)
-        else:
-            counts[bitstr] = int(shots * 0.3 / max(1, K - 1))
-    
+    counts = {pats[i]: int(shots * 0.7) if i == min_idx else int(shots * 0.3 / max(1, K - 1))
+              for i in range(K)}
+
     # Ensure total adds up
     total = sum(counts.values())
     if total < shots:
-        best_bitstr = '0' * K
-        best_bitstr = best_bitstr[:min_idx] + '1' + best_bitstr[min_idx+1:]
-        counts[best_bitstr] += (shots - total)
-    
+        counts[pats[min_idx]] += (shots - total)
+
     return counts
 
 def run_qaoa_assignment(costs: np.ndarray, backend, shots: int = 1000, p: int = 1, A: float = 2.0,
-                        grid: Optional[List[Tuple[float, float]]] = None) -> Tuple[Dict[int, int], Tuple[float, float]]:
+                        grid: Optional[List[Tuple[float, float]]] = None,
+                        template: Optional[Tuple[QuantumCircuit, List[Tuple]]] = None) -> Tuple[Dict[int, int], Tuple[float, float]]:
     """
     Optimized QAOA assignment with parallel parameter search and smart fallbacks.
     """
@@ -218,38 +400,52 @@ def run_qaoa_assignment(costs: np.ndarray, backend, shots: int = 1000, p: int =
     best_E = float("inf")
     best_counts: Dict[str, int] = {}
     best_pair = (0.3, 0.7)
-    
-    # Try parallel execution for speed
+
+    # Submit the whole grid as one batched job: Aer parallelizes experiments
+    # internally, so wrapping simulator calls in a Python thread pool only
+    # added GIL and BLAS contention plus a timeout path.
     try:
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            # Prepare arguments for parallel execution
-            args_list = [(g, b, costs, A, adaptive_shots, backend) for g, b in grid]
-            
-            # Submit all jobs
-            futures = {executor.submit(_execute_single_parameter, args): args[:2] for args in args_list}
-            
-            # Collect results with timeout
-            for future in as_completed(futures, timeout=30):  # 30s timeout
-                try:
-                    energy, counts, params = future.result(timeout=10)
-                    
-                    if energy < best_E and counts:
-                        best_E = energy
-                        best_counts = counts
-                        best_pair = params
-                        print(f"New best: {params} -> {energy:.4f}")
-                        
-                except Exception as e:
-                    print(f"Parameter execution failed: {e}")
-                    continue
-                    
+        if template is None and not hasattr(backend, 'configuration'):
+            template = _cached_ansatz(K)
+
+        pm = None
+        if template is None and hasattr(backend, 'configuration'):
+            pm = _pm_for(backend)
+
+        if template is not None:
+            circuits = [bind_qaoa_ansatz(template[0], template[1], costs, [g], [b], A)
+                        for g, b in grid]
+        elif Parallel is not None and len(grid) > 1:
+            # Per-circuit transpilation against a real backend is the slow
+            # part here; loky workers sidestep the GIL for it
+            circuits = Parallel(n_jobs=min(len(grid), os.cpu_count() or 1), prefer='processes')(
+                delayed(pm.run)(build_qaoa_circuit_fast(costs, g, b, A)) for g, b in grid
+            )
+        else:
+            circuits = [pm.run(build_qaoa_circuit_fast(costs, g, b, A)) for g, b in grid]
+
+        try:
+            backend.set_options(max_parallel_experiments=len(grid))
+        except Exception:
+            pass  # Real backends need no experiment-scheduling hint
+
+        result = backend.run(circuits, shots=adaptive_shots).result()
+        for i, (g, b) in enumerate(grid):
+            counts = result.get_counts(i)
+            energy = _energy_from_counts(counts, costs, A, adaptive_shots)
+            if energy < best_E and counts:
+                best_E = energy
+                best_counts = counts
+                best_pair = (g, b)
+                print(f"New best: {(g, b)} -> {energy:.4f}")
+
     except Exception as e:
-        print(f"Parallel execution failed: {e}")
+        print(f"Batched execution failed: {e}")
         # Fall back to sequential execution with reduced grid
         for gamma, beta in grid[:3]:  # Only try 3 combinations
             try:
                 energy, counts, params = _execute_single_parameter(
-                    (gamma, beta, costs, A, adaptive_shots, backend)
+                    (gamma, beta, costs, A, adaptive_shots, backend, template)
                 )
                 
                 if energy < best_E and counts:
@@ -269,21 +465,21 @@ def run_qaoa_assignment(costs: np.ndarray, backend, shots: int = 1000, p: int =
     
     print(f"Best parameters: {best_pair}, Energy: {best_E:.4f}")
     
-    # Convert to assignment counts by index
+    # Convert to assignment counts by index: unpack all outcomes at once,
+    # credit one-hot rows to their single vehicle and split multi-hot rows
+    # evenly, all via array ops instead of the old nested Python loops
     counts_by_index: Dict[int, int] = {}
-    
-    for bitstr, count in best_counts.items():
-        bit_tuple = tuple(int(b) for b in bitstr[::-1])
-        ones = [i for i, v in enumerate(bit_tuple) if v == 1]
-        
-        if len(ones) == 1:
-            # Perfect one-hot assignment
-            idx = ones[0]
-            counts_by_index[idx] = counts_by_index.get(idx, 0) + count
-        elif len(ones) > 1:
-            # Distribute among multiple assignments
-            for idx in ones:
-                counts_by_index[idx] = counts_by_index.get(idx, 0) + count // len(ones)
+    if best_counts:
+        X, cnt = _unpack_counts(best_counts, K)
+        ones = X.sum(axis=1)
+        tally = np.zeros(K)
+        single = ones == 1
+        if single.any():
+            tally += np.bincount(X[single].argmax(axis=1), weights=cnt[single], minlength=K)
+        multi = ones > 1
+        if multi.any():
+            tally += ((cnt[multi] // ones[multi])[:, None] * X[multi]).sum(axis=0)
+        counts_by_index = {int(i): int(v) for i, v in enumerate(tally) if v > 0}
     
     # Ensure we have at least one assignment
     if not counts_by_index:
@@ -72,6 +72,14 @@ def build_sample_dataset() -> Dict:
 # Geographic / Feature utilities
 # -----------------------------
 
+# Optional: numba compiles the scalar haversine (called from tight loops in
+# preprocessing and the constraint layer) down to native trigonometry.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
 def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     R = 6371.0  # Earth radius in km
     p1 = math.radians(lat1)
@@ -83,6 +91,26 @@ def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return R * c
 
 
+if njit is not None:
+    haversine_km = njit(cache=True, fastmath=True)(haversine_km)
+
+    @njit(cache=True, fastmath=True, parallel=True)
+    def haversine_km_batch(lat1: float, lon1: float, lat2s: np.ndarray, lon2s: np.ndarray) -> np.ndarray:  # pragma: no cover
+        out = np.empty(lat2s.shape[0])
+        for i in prange(lat2s.shape[0]):
+            out[i] = haversine_km(lat1, lon1, lat2s[i], lon2s[i])
+        return out
+else:
+    def haversine_km_batch(lat1: float, lon1: float, lat2s: np.ndarray, lon2s: np.ndarray) -> np.ndarray:
+        """Distances from one point to arrays of points, vectorized in NumPy."""
+        p1 = np.radians(lat1)
+        p2 = np.radians(lat2s)
+        dphi = np.radians(lat2s - lat1)
+        dlmb = np.radians(lon2s - lon1)
+        a = np.sin(dphi / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dlmb / 2) ** 2
+        return 2.0 * 6371.0 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
 def minmax_scale(values: np.ndarray, eps: float = 1e-9) -> np.ndarray:
     vmin = float(np.min(values))
     vmax = float(np.max(values))
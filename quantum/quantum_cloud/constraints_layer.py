@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+from dataclasses import dataclass
 from typing import Dict, List, Tuple
 
+import numpy as np
 import pandas as pd
 
-from vrp_data import Vehicle, Depot, haversine_km
+from vrp_data import Vehicle, Depot, haversine_km_vec
 import logging
 logger = logging.getLogger(__name__)
 
@@ -15,21 +17,52 @@ def compute_depot_for_vehicle(veh: Vehicle, depots: Dict[str, Depot]) -> Depot:
     return depots[veh.current_location]
 
 
+@dataclass
+class PrecomputedGeo:
+    """Depot-to-location haversine matrix shared across constraint passes.
+
+    One broadcast build replaces a scalar trig call per (vehicle, location)
+    pair on every distance estimate; callers invoking
+    estimate_total_distance_km repeatedly should build once and pass through.
+    """
+    dist: np.ndarray  # (num_vehicles, num_locations) km
+    vid_idx: Dict[str, int]
+    loc_idx: Dict[str, int]
+
+    @classmethod
+    def build(cls, vehicles: Dict[str, Vehicle], depots: Dict[str, Depot], loc_df: pd.DataFrame) -> "PrecomputedGeo":
+        deps = [compute_depot_for_vehicle(vehicles[vid], depots) for vid in vehicles]
+        dep_lat = np.fromiter((d.lat for d in deps), dtype=np.float64, count=len(deps))
+        dep_lon = np.fromiter((d.lon for d in deps), dtype=np.float64, count=len(deps))
+        dist = haversine_km_vec(
+            dep_lat[:, None], dep_lon[:, None],
+            loc_df["lat"].to_numpy(np.float64)[None, :],
+            loc_df["lon"].to_numpy(np.float64)[None, :],
+        )
+        return cls(
+            dist=dist,
+            vid_idx={vid: i for i, vid in enumerate(vehicles)},
+            loc_idx={lid: i for i, lid in enumerate(loc_df["location_id"])},
+        )
+
+
 def estimate_total_distance_km(
     assignments: Dict[str, List[str]],
     vehicles: Dict[str, Vehicle],
     depots: Dict[str, Depot],
     loc_df: pd.DataFrame,
+    geo: PrecomputedGeo | None = None,
 ) -> Dict[str, float]:
-    by_loc = {r.location_id: r for r in loc_df.itertuples(index=False)}
+    if geo is None:
+        geo = PrecomputedGeo.build(vehicles, depots, loc_df)
     total: Dict[str, float] = {}
     for vid, locs in assignments.items():
-        dep = compute_depot_for_vehicle(vehicles[vid], depots)
-        s = 0.0
-        for lid in locs:
-            r = by_loc[lid]
-            s += haversine_km(dep.lat, dep.lon, float(r.lat), float(r.lon))
-        total[vid] = s
+        if locs:
+            row = geo.dist[geo.vid_idx[vid]]
+            idx = np.fromiter((geo.loc_idx[lid] for lid in locs), dtype=np.intp, count=len(locs))
+            total[vid] = float(row[idx].sum())
+        else:
+            total[vid] = 0.0
     return total
 
 
@@ -110,13 +143,14 @@ def enforce_constraints(
 
     # Adjust for distance/time constraints with iteration limit
     AVG_SPEED_KMPH = 30.0
+    geo = PrecomputedGeo.build(vehicles, depots, loc_df)
     change_loop = True
     dist_iter = 0
     max_dist_iter = 10
     while change_loop and dist_iter < max_dist_iter:
         change_loop = False
         dist_iter += 1
-        total_dist = estimate_total_distance_km(assignments, vehicles, depots, loc_df)
+        total_dist = estimate_total_distance_km(assignments, vehicles, depots, loc_df, geo=geo)
         for vid in allowed_vehicles:
             dist = total_dist.get(vid, 0.0)
             time_est = dist / AVG_SPEED_KMPH
@@ -137,7 +171,7 @@ def enforce_constraints(
                     assignments.setdefault(alt, []).append(lid)
                     break
                 removed_any = True
-                total_dist = estimate_total_distance_km(assignments, vehicles, depots, loc_df)
+                total_dist = estimate_total_distance_km(assignments, vehicles, depots, loc_df, geo=geo)
                 dist = total_dist.get(vid, 0.0)
                 time_est = dist / AVG_SPEED_KMPH
                 if dist <= max_dist + 1e-6 and time_est <= max_time + 1e-6:
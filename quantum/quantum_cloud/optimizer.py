@@ -1,347 +1,510 @@
-from __future__ import annotations
-
-from typing import Any, Dict, Optional, List
-import numpy as np
-import pandas as pd
-import logging
-
-# Import your existing modules
-from vrp_data import load_data, preprocess_to_features
-from constraints_layer import enforce_constraints, compute_depot_for_vehicle, estimate_total_distance_km
-from vrp_data import haversine_km
-from vrp_utils import cluster_locations, get_distance_matrix
-from qaoa_assign import run_qaoa_assignment, run_qaoa_assignment_batch
-
-logger = logging.getLogger(__name__)
-
-
-def compute_enhanced_costs(location_data: pd.Series, vehicles: Dict, depots: Dict, current_assignments: Dict[str, List[str]] = None) -> np.ndarray:
-    """
-    Compute enhanced cost function that considers multiple factors to prevent
-    all locations being assigned to the same vehicle.
-    """
-    vehicle_ids = list(vehicles.keys())
-    costs = np.zeros(len(vehicle_ids))
-    
-    # Track current load distribution if assignments are provided
-    if current_assignments is None:
-        current_assignments = {vid: [] for vid in vehicle_ids}
-    
-    for i, vid in enumerate(vehicle_ids):
-        vehicle = vehicles[vid]
-        depot = depots.get(vehicle.current_location, list(depots.values())[0])
-        
-        # Base distance cost
-        distance = haversine_km(
-            float(location_data["lat"]), float(location_data["lon"]),
-            depot.lat, depot.lon
-        )
-        
-        # Vehicle capacity factor (prefer vehicles with more capacity for high-demand locations)
-        capacity_factor = vehicle.capacity / 1500.0  # Normalize to typical max capacity
-        demand_factor = float(location_data["demand"]) / 500.0  # Normalize to typical max demand
-        
-        # Current load factor - heavily penalize overloaded vehicles
-        current_load = sum(100 for _ in current_assignments.get(vid, []))  # Simplified load calculation
-        load_factor = (current_load + float(location_data["demand"])) / vehicle.capacity
-        capacity_penalty = 0 if load_factor <= 1.0 else (load_factor - 1.0) * 10  # Heavy penalty for overload
-        
-        # Priority matching (high priority locations prefer faster vehicles)
-        # Handle both scaled and unscaled priority
-        if "priority_scaled" in location_data:
-            priority_weight = float(location_data["priority_scaled"])
-        else:
-            # Scale priority manually (lower priority number = higher priority)
-            raw_priority = float(location_data.get("priority", 2))
-            priority_weight = 1.0 - (raw_priority - 1.0) / 2.0  # Assuming priority range 1-3
-        vehicle_speed_factor = 1.0 if vehicle.type == "large" else (0.8 if vehicle.type == "medium" else 0.6)
-        priority_mismatch = abs(priority_weight - vehicle_speed_factor)
-        
-        # Load balancing factor - prefer less loaded vehicles
-        current_stops = len(current_assignments.get(vid, []))
-        max_stops = max(len(locs) for locs in current_assignments.values()) if current_assignments else 0
-        load_imbalance = current_stops / max(1, max_stops + 1)  # Normalize current load
-        
-        # Distance variation to encourage different depot usage
-        base_distance_penalty = distance / 50.0  # Normalize distance
-        
-        # Combined cost with stronger differentiation
-        costs[i] = (
-            base_distance_penalty * 0.3 +  # Distance factor
-            abs(capacity_factor - demand_factor) * 0.2 +  # Capacity-demand matching
-            priority_mismatch * 0.1 +  # Priority matching
-            load_imbalance * 0.3 +  # Load balancing - encourage even distribution
-            capacity_penalty * 0.1 +  # Capacity constraint penalty
-            (i * 0.02)  # Small vehicle index diversity
-        )
-    
-    return costs
-
-
-def optimize_vrp(raw: Dict, shots: int = 2000, include_counts: bool = True, method: str = "qaoa",
-                 qaoa_penalty: float = 3.0, qaoa_p: int = 2, qaoa_grid_vals: Optional[List[float]] = None,
-                 backend=None, save_circuit: bool = False) -> Dict:
-    """
-    Return a structured JSON-friendly result for the VRP assignment using QAOA.
-    
-    Args:
-        raw: Input data dictionary
-        shots: Number of shots for quantum sampling
-        include_counts: Whether to include measurement counts in output
-        method: Only "qaoa" is supported (PQC removed)
-        qaoa_penalty: QAOA penalty parameter for one-hot constraint
-        qaoa_p: Number of QAOA layers
-        qaoa_grid_vals: Parameter values for QAOA grid search
-        backend: IBM Quantum backend for QAOA method
-    
-    Returns:
-        Dictionary with VRP optimization results
-    """
-    try:
-        if method != "qaoa":
-            raise ValueError("Only QAOA method is supported. PQC has been removed.")
-            
-        if backend is None:
-            raise ValueError("Backend is required for QAOA method")
-            
-        logger.info(f"Starting VRP optimization with QAOA: {len(raw.get('locations', []))} locations, {len(raw.get('vehicles', []))} vehicles")
-        
-        data = load_data(data=raw)
-        loc_df, vehicles, depots = preprocess_to_features(data)
-        num_trucks = len(vehicles)
-        vehicle_ids = list(vehicles.keys())
-        
-        logger.info(f"Processed data: {len(loc_df)} locations, {num_trucks} vehicles")
-
-        # Handle large location sets by clustering if necessary
-        max_locations_per_cluster = 6 if len(loc_df) > 50 else 8  # Smaller clusters for very large problems
-        
-        if len(loc_df) > 10:  # More aggressive clustering
-            logger.info(f"Large location set detected ({len(loc_df)} locations), applying clustering...")
-            locations_for_clustering = []
-            for _, row in loc_df.iterrows():
-                locations_for_clustering.append({
-                    'id': row.location_id,
-                    'lat': row.lat,
-                    'lon': row.lon,
-                    'demand': row.demand,
-                    'priority': row.priority
-                })
-            
-            clusters = cluster_locations(locations_for_clustering, max_cluster_size=max_locations_per_cluster)
-            logger.info(f"Created {len(clusters)} clusters (max {max_locations_per_cluster} locations per cluster)")
-        else:
-            clusters = [loc_df.to_dict('records')]
-
-        counts_by_loc_id: Dict[str, Dict[str, int]] = {}
-        ranking_by_loc_id: Dict[str, List[str]] = {}
-
-        def tuple_to_series(t):
-            """Convert namedtuple to pandas Series."""
-            if hasattr(t, "_asdict"):
-                d = t._asdict()
-            else:
-                fields = getattr(t, "_fields", [])
-                d = {name: getattr(t, name) for name in fields}
-            return pd.Series(d)
-
-        # Process each cluster
-        for cluster_idx, cluster in enumerate(clusters):
-            logger.info(f"Processing cluster {cluster_idx + 1}/{len(clusters)} with {len(cluster)} locations")
-            
-            costs_list = []
-            loc_ids = []
-            
-            # Process each location in the cluster
-            for location in cluster:
-                if isinstance(location, dict):
-                    # Check if this is from clustering (has 'id') or from DataFrame records (has 'location_id')
-                    if 'id' in location:
-                        # From clustering
-                        lid = str(location['id'])
-                    else:
-                        # From DataFrame.to_dict('records') - uses 'location_id'
-                        lid = str(location['location_id'])
-                    row_data = pd.Series(location)
-                else:
-                    # From itertuples
-                    lid = str(location.location_id)
-                    row_data = tuple_to_series(location)
-                    
-                loc_ids.append(lid)
-                
-                # Compute enhanced costs (no normalization to preserve differentiation)
-                costs = compute_enhanced_costs(row_data, vehicles, depots)
-                costs_list.append(costs)
-
-            # Adaptive parameters based on cluster size
-            cluster_size = len(cluster)
-            fast_mode = cluster_size <= 4 or len(clusters) > 5  # Use fast mode for small clusters or many clusters
-            
-            if qaoa_grid_vals is not None:
-                grid = [(g, b) for g in qaoa_grid_vals for b in qaoa_grid_vals]
-            else:
-                grid = None  # Let the QAOA function decide
-                
-            logger.info(f"Using adaptive QAOA parameters (fast_mode={fast_mode})")
-
-            # Run batched QAOA for this cluster with optimizations
-            # Save circuit only for the first cluster and first location
-            save_circ = save_circuit and cluster_idx == 0
-            
-            if save_circ and len(costs_list) > 0:
-                # Use single QAOA call for circuit saving
-                first_result = run_qaoa_assignment(
-                    costs=costs_list[0],
-                    backend=backend,
-                    shots=shots,
-                    p=qaoa_p,
-                    A=qaoa_penalty,
-                    grid=grid,
-                    fast_mode=fast_mode,
-                    save_circuit=True
-                )
-                # Still run batch for the rest
-                if len(costs_list) > 1:
-                    batch_results_rest = run_qaoa_assignment_batch(
-                        costs_list=costs_list[1:],
-                        backend=backend,
-                        shots=shots,
-                        p=qaoa_p,
-                        A=qaoa_penalty,
-                        grid=grid,
-                        fast_mode=fast_mode
-                    )
-                    batch_results = [first_result] + batch_results_rest
-                else:
-                    batch_results = [first_result]
-            else:
-                batch_results = run_qaoa_assignment_batch(
-                    costs_list=costs_list,
-                    backend=backend,
-                    shots=shots,
-                    p=qaoa_p,
-                    A=qaoa_penalty,
-                    grid=grid,
-                    fast_mode=fast_mode
-                )
-
-            # Populate counts and ranking from batch results
-            for lid, (counts_idx, best_pair) in zip(loc_ids, batch_results):
-                if include_counts:
-                    counts_by_loc_id[lid] = {vehicle_ids[i]: int(c) for i, c in counts_idx.items() if i < num_trucks}
-                    
-                if counts_idx and sum(counts_idx.values()) > 0:
-                    # Sort by counts (highest first)
-                    order_idx = sorted(range(num_trucks), key=lambda i: counts_idx.get(i, 0), reverse=True)
-                else:
-                    # Fallback: sort by cost (lowest first)
-                    li = loc_ids.index(lid)
-                    costs = costs_list[li]
-                    order_idx = sorted(range(num_trucks), key=lambda i: costs[i])
-                    
-                ranking_by_loc_id[lid] = [vehicle_ids[i] for i in order_idx]
-                logger.debug(f"Location {lid} ranking: {ranking_by_loc_id[lid][:3]}...")  # Show top 3
-
-        logger.info("QAOA processing completed, applying constraints...")
-        
-        # Create initial assignments using balanced greedy: assign to best feasible vehicle considering capacity and current load
-        assignments: Dict[str, List[str]] = {vid: [] for vid in vehicle_ids}
-        by_loc = {r.location_id: r for r in loc_df.itertuples(index=False)}
-        max_stops = int(data.get("constraints", {}).get("max_stops_per_vehicle", 9999))
-        for lid, order_ids in ranking_by_loc_id.items():
-            # Recompute costs considering current assignments to encourage distribution
-            location_row = by_loc[lid]
-            location_data = pd.Series({
-                'lat': location_row.lat,
-                'lon': location_row.lon,
-                'demand': location_row.demand,
-                'priority_scaled': location_row.priority_scaled
-            })
-            
-            # Get current costs with assignment awareness
-            current_costs = compute_enhanced_costs(location_data, vehicles, depots, assignments)
-            
-            # Rerank vehicles by current cost (lower is better)
-            cost_ranking = sorted(enumerate(vehicle_ids), key=lambda x: current_costs[x[0]])
-            
-            chosen_vid = None
-            for idx, vid in cost_ranking:
-                # Check stops constraint
-                if len(assignments[vid]) >= max_stops:
-                    continue
-                # Check capacity constraint
-                current_demand = sum(float(by_loc[ll].demand) for ll in assignments[vid])
-                if current_demand + float(by_loc[lid].demand) <= vehicles[vid].capacity + 1e-6:
-                    chosen_vid = vid
-                    break
-            if chosen_vid is None:
-                # Fallback to least loaded vehicle by stops
-                chosen_vid = min(vehicle_ids, key=lambda v: len(assignments[v]))
-            assignments[chosen_vid].append(lid)
-
-        logger.info(f"Initial assignments: {[(vid, len(locs)) for vid, locs in assignments.items()]}")
-        
-        # Enforce constraints and handle capacity/distance violations
-        assignments, unassigned = enforce_constraints(
-            assignments, ranking_by_loc_id, vehicles, depots, loc_df, 
-            data.get("constraints", {})
-        )
-        
-        logger.info(f"Final assignments after constraints: {[(vid, len(locs)) for vid, locs in assignments.items()]}")
-        if unassigned:
-            logger.warning(f"Unassigned locations: {unassigned}")
-
-        # Create lookup for location data
-        by_loc = {r.location_id: r for r in loc_df.itertuples(index=False)}
-        
-        # Calculate per-vehicle summary statistics
-        per_vehicle_summary: Dict[str, Dict[str, float]] = {}
-        for vid, locs in assignments.items():
-            total_demand = sum(float(by_loc[lid].demand) for lid in locs)
-            per_vehicle_summary[vid] = {
-                "stops": int(len(locs)),
-                "total_demand": float(total_demand),
-                "approx_distance_km": 0.0,  # will be filled below
-            }
-
-        # Compute distances accurately
-        distance_map = estimate_total_distance_km(assignments, vehicles, depots, loc_df)
-        for vid in per_vehicle_summary:
-            per_vehicle_summary[vid]["approx_distance_km"] = float(round(distance_map.get(vid, 0.0), 4))
-
-        # Build final result
-        result: Dict[str, Any] = {
-            "status": "success",
-            "method": method,
-            "meta": {
-                "num_trucks": num_trucks, 
-                "num_locations": int(len(loc_df)),
-                "shots": shots,
-                "qaoa_layers": qaoa_p,
-                "qaoa_penalty": qaoa_penalty,
-                "backend": backend.name if backend and hasattr(backend, 'name') else "simulator"
-            },
-            "assignments": assignments,
-            "per_vehicle_summary": per_vehicle_summary,
-            "unassigned": unassigned,
-        }
-        
-        if include_counts:
-            result["counts_by_location"] = counts_by_loc_id
-            
-        logger.info("VRP optimization completed successfully")
-        return result
-        
-    except Exception as e:
-        logger.error(f"VRP optimization failed: {str(e)}")
-        # Return error information for debugging
-        return {
-            "status": "error",
-            "message": str(e),
-            "method": method,
-            "meta": {
-                "shots": shots,
-                "backend": backend.name if backend and hasattr(backend, 'name') else "unknown"
-            }
-        }
+from __future__ import annotations
+
+from typing import Any, Dict, Optional, List, Sequence
+import numpy as np
+import pandas as pd
+import logging
+
+# Import your existing modules
+from vrp_data import load_data, preprocess_to_features, haversine_km_vec
+from constraints_layer import enforce_constraints, compute_depot_for_vehicle, estimate_total_distance_km
+from vrp_utils import cluster_locations, get_distance_matrix
+from qaoa_assign import run_qaoa_assignment_batch
+
+logger = logging.getLogger(__name__)
+
+# Optional: numba fuses the per-location greedy rescoring into one native
+# kernel, removing the interpreter from the hottest classical loop.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, nogil=True, fastmath=True)
+    def _greedy_score_kernel(dist_row, caps, speed_factor, stops, demand, priority_weight):  # pragma: no cover
+        V = dist_row.shape[0]
+        out = np.empty(V)
+        max_stops = 0.0
+        for i in range(V):
+            if stops[i] > max_stops:
+                max_stops = stops[i]
+        for i in range(V):
+            load_factor = (stops[i] * 100.0 + demand) / caps[i]
+            cap_pen = (load_factor - 1.0) * 10.0 if load_factor > 1.0 else 0.0
+            load_imb = stops[i] / (max_stops + 1.0)
+            out[i] = ((dist_row[i] / 50.0) * 0.3
+                      + abs(caps[i] / 1500.0 - demand / 500.0) * 0.2
+                      + abs(priority_weight - speed_factor[i]) * 0.1
+                      + load_imb * 0.3
+                      + cap_pen * 0.1
+                      + i * 0.02)
+        return out
+else:
+    _greedy_score_kernel = None
+
+# Cache of QAOA grid-search results keyed by a rounded cost vector plus run
+# parameters. Clustered geographies produce many near-identical normalized
+# cost vectors, so identical problems become O(1) dict lookups.
+_QAOA_GRID_CACHE: Dict[tuple, tuple] = {}
+_QAOA_GRID_CACHE_MAX = 4096
+
+
+def _qaoa_cache_key(costs: np.ndarray, shots: int, p: int, A: float) -> tuple:
+    # Rounding to 4 decimals controls hit rate vs fidelity
+    return (tuple(np.round(costs, 4).tolist()), int(shots), int(p), float(A))
+
+
+def compute_enhanced_costs(location_data: Dict[str, Any], vehicles: Dict, depots: Dict, current_assignments: Dict[str, List[str]] = None,
+                           distance_row: Optional[np.ndarray] = None,
+                           caps: Optional[np.ndarray] = None,
+                           speed_factor: Optional[np.ndarray] = None,
+                           vehicle_ids: Optional[Sequence[str]] = None) -> np.ndarray:
+    """
+    Compute enhanced cost function that considers multiple factors to prevent
+    all locations being assigned to the same vehicle.
+
+    When distance_row (precomputed location->depot distances per vehicle) is
+    provided the scalar haversine calls are skipped entirely. caps and
+    speed_factor are per-vehicle constants; callers in a loop should build
+    them once and pass them through instead of paying the rebuild per call,
+    along with the cached vehicle_ids sequence.
+    """
+    if vehicle_ids is None:
+        vehicle_ids = tuple(vehicles.keys())
+    V = len(vehicle_ids)
+    demand = float(location_data["demand"])
+
+    # Track current load distribution if assignments are provided
+    if current_assignments is None:
+        current_assignments = {vid: [] for vid in vehicle_ids}
+
+    # Base distance cost, one vectorized haversine instead of V scalar calls
+    if distance_row is not None:
+        distance = np.asarray(distance_row, dtype=float)
+    else:
+        # Resolve each vehicle's depot once; the dict.get default used to
+        # build list(depots.values()) on every vehicle of every location
+        default_depot = next(iter(depots.values()))
+        dep = [depots.get(vehicles[vid].current_location, default_depot) for vid in vehicle_ids]
+        distance = haversine_km_vec(
+            float(location_data["lat"]), float(location_data["lon"]),
+            np.array([d.lat for d in dep]), np.array([d.lon for d in dep])
+        )
+
+    # Vehicle capacity factor (prefer vehicles with more capacity for high-demand locations)
+    if caps is None:
+        caps = np.array([vehicles[vid].capacity for vid in vehicle_ids], dtype=float)
+    capacity_factor = caps / 1500.0  # Normalize to typical max capacity
+    demand_factor = demand / 500.0  # Normalize to typical max demand
+
+    # Current load factor - heavily penalize overloaded vehicles
+    current_stops = np.array([len(current_assignments.get(vid, [])) for vid in vehicle_ids], dtype=float)
+    current_load = current_stops * 100.0  # Simplified load calculation
+    load_factor = (current_load + demand) / caps
+    capacity_penalty = np.maximum(0.0, load_factor - 1.0) * 10  # Heavy penalty for overload
+
+    # Priority matching (high priority locations prefer faster vehicles)
+    # Handle both scaled and unscaled priority
+    if "priority_scaled" in location_data:
+        priority_weight = float(location_data["priority_scaled"])
+    else:
+        # Scale priority manually (lower priority number = higher priority)
+        raw_priority = float(location_data.get("priority", 2))
+        priority_weight = 1.0 - (raw_priority - 1.0) / 2.0  # Assuming priority range 1-3
+    if speed_factor is None:
+        speed_factor = np.array([1.0 if vehicles[vid].type == "large" else (0.8 if vehicles[vid].type == "medium" else 0.6)
+                                 for vid in vehicle_ids])
+    priority_mismatch = np.abs(priority_weight - speed_factor)
+
+    # Load balancing factor - prefer less loaded vehicles
+    max_stops = max((len(locs) for locs in current_assignments.values()), default=0)
+    load_imbalance = current_stops / max(1, max_stops + 1)  # Normalize current load
+
+    # Combined cost with stronger differentiation
+    return (
+        (distance / 50.0) * 0.3 +  # Distance factor (normalized)
+        np.abs(capacity_factor - demand_factor) * 0.2 +  # Capacity-demand matching
+        priority_mismatch * 0.1 +  # Priority matching
+        load_imbalance * 0.3 +  # Load balancing - encourage even distribution
+        capacity_penalty * 0.1 +  # Capacity constraint penalty
+        np.arange(V) * 0.02  # Small vehicle index diversity
+    )
+
+
+def enhanced_cost_matrix(loc_df: pd.DataFrame, vehicles: Dict, depots: Dict,
+                         depot_dist: np.ndarray) -> np.ndarray:
+    """Static (L, V) enhanced-cost matrix for the pre-assignment phase.
+
+    Broadcasts the same factors as compute_enhanced_costs with no current
+    assignments (zero stops per vehicle), so one matrix build replaces a
+    per-location call during cluster processing.
+    """
+    vehicle_ids = list(vehicles.keys())
+    V = len(vehicle_ids)
+    demand = loc_df["demand"].to_numpy(dtype=float)[:, None]
+    caps = np.array([vehicles[vid].capacity for vid in vehicle_ids], dtype=float)[None, :]
+    speed_factor = np.array([1.0 if vehicles[vid].type == "large" else (0.8 if vehicles[vid].type == "medium" else 0.6)
+                             for vid in vehicle_ids])[None, :]
+    priority_weight = loc_df["priority_scaled"].to_numpy(dtype=float)[:, None]
+
+    capacity_penalty = np.maximum(0.0, demand / caps - 1.0) * 10
+    return (
+        (depot_dist / 50.0) * 0.3 +
+        np.abs(caps / 1500.0 - demand / 500.0) * 0.2 +
+        np.abs(priority_weight - speed_factor) * 0.1 +
+        capacity_penalty * 0.1 +
+        np.arange(V)[None, :] * 0.02
+    )
+
+
+def optimize_vrp(raw: Dict, shots: int = 2000, include_counts: bool = True, method: str = "qaoa",
+                 qaoa_penalty: float = 3.0, qaoa_p: int = 2, qaoa_grid_vals: Optional[List[float]] = None,
+                 backend=None, save_circuit: bool = False) -> Dict:
+    """
+    Return a structured JSON-friendly result for the VRP assignment using QAOA.
+    
+    Args:
+        raw: Input data dictionary
+        shots: Number of shots for quantum sampling
+        include_counts: Whether to include measurement counts in output
+        method: Only "qaoa" is supported (PQC removed)
+        qaoa_penalty: QAOA penalty parameter for one-hot constraint
+        qaoa_p: Number of QAOA layers
+        qaoa_grid_vals: Parameter values for QAOA grid search
+        backend: IBM Quantum backend for QAOA method
+    
+    Returns:
+        Dictionary with VRP optimization results
+    """
+    try:
+        if method != "qaoa":
+            raise ValueError("Only QAOA method is supported. PQC has been removed.")
+            
+        if backend is None:
+            raise ValueError("Backend is required for QAOA method")
+            
+        logger.info(f"Starting VRP optimization with QAOA: {len(raw.get('locations', []))} locations, {len(raw.get('vehicles', []))} vehicles")
+        
+        data = load_data(data=raw)
+        loc_df, vehicles, depots = preprocess_to_features(data)
+        num_trucks = len(vehicles)
+        vehicle_ids = list(vehicles.keys())
+
+        logger.info(f"Processed data: {len(loc_df)} locations, {num_trucks} vehicles")
+
+        # Precompute all location->depot distances. Prefer a distance_matrix
+        # supplied in the request (depot rows x location columns, as produced
+        # by get_distance_matrix) so QAOA costs use the same road distances as
+        # the rest of the pipeline; otherwise fall back to one vectorized
+        # haversine call instead of O(N*M) scalar calls in the location loops.
+        default_depot = next(iter(depots.values()))
+        # Resolve every vehicle's depot exactly once; all later passes read
+        # from this list (or the arrays derived from it) instead of doing a
+        # dict.get per vehicle per location
+        depot_for_v = [depots.get(vehicles[vid].current_location, default_depot) for vid in vehicle_ids]
+        depot_order = [d["id"] for d in data["depots"]]
+        depot_idx_by_vehicle = [
+            depot_order.index(vehicles[vid].current_location)
+            if vehicles[vid].current_location in depot_order else 0
+            for vid in vehicle_ids
+        ]
+        dm = data.get("distance_matrix")
+        if dm is not None and np.shape(dm) == (len(depot_order), len(loc_df)):
+            depot_dist = np.asarray(dm, dtype=float).T[:, depot_idx_by_vehicle]
+        else:
+            dep_lat = np.fromiter((d.lat for d in depot_for_v), dtype=np.float64, count=num_trucks)
+            dep_lon = np.fromiter((d.lon for d in depot_for_v), dtype=np.float64, count=num_trucks)
+            depot_dist = haversine_km_vec(
+                loc_df["lat"].to_numpy()[:, None], loc_df["lon"].to_numpy()[:, None],
+                dep_lat[None, :], dep_lon[None, :]
+            )
+        loc_row_idx = {str(lid): i for i, lid in enumerate(loc_df["location_id"])}
+
+        # Full (L, V) cost matrix in one broadcast; the cluster phase below
+        # slices rows instead of recomputing costs per location
+        cost_matrix = enhanced_cost_matrix(loc_df, vehicles, depots, depot_dist)
+
+        # Handle large location sets by clustering if necessary
+        max_locations_per_cluster = 6 if len(loc_df) > 50 else 8  # Smaller clusters for very large problems
+        
+        if len(loc_df) > 10:  # More aggressive clustering
+            logger.info(f"Large location set detected ({len(loc_df)} locations), applying clustering...")
+            locations_for_clustering = []
+            for _, row in loc_df.iterrows():
+                locations_for_clustering.append({
+                    'id': row.location_id,
+                    'lat': row.lat,
+                    'lon': row.lon,
+                    'demand': row.demand,
+                    'priority': row.priority
+                })
+            
+            clusters = cluster_locations(locations_for_clustering, max_cluster_size=max_locations_per_cluster)
+            logger.info(f"Created {len(clusters)} clusters (max {max_locations_per_cluster} locations per cluster)")
+        else:
+            clusters = [loc_df.to_dict('records')]
+
+        counts_by_loc_id: Dict[str, Dict[str, int]] = {}
+        ranking_by_loc_id: Dict[str, List[str]] = {}
+        qaoa_cache_hits = 0
+        # Hoisted level checks: the per-location debug f-string and the
+        # assignment-summary list comprehensions are only built when their
+        # level is actually enabled
+        log_debug = logger.isEnabledFor(logging.DEBUG)
+        log_info = logger.isEnabledFor(logging.INFO)
+
+        def _record_lid(location) -> str:
+            """Location id of a cluster record (dict from clustering, dict from
+            to_dict('records'), or itertuples namedtuple)."""
+            if isinstance(location, dict):
+                return str(location['id'] if 'id' in location else location['location_id'])
+            return str(location.location_id)
+
+        # Normalize every cluster to its location ids once, so the per-cluster
+        # processing below is branchless
+        cluster_lids = [[_record_lid(loc) for loc in cluster] for cluster in clusters]
+
+        # Phase 1: build per-cluster cost vectors and resolve cache hits
+        cluster_jobs: List[Dict[str, Any]] = []
+        for cluster_idx, loc_ids in enumerate(cluster_lids):
+            logger.info(f"Processing cluster {cluster_idx + 1}/{len(clusters)} with {len(loc_ids)} locations")
+
+            # Enhanced costs (no normalization to preserve differentiation)
+            # gathered as one contiguous (cluster_size, V) block instead of
+            # a Python list of row views
+            cluster_rows = np.fromiter((loc_row_idx[lid] for lid in loc_ids),
+                                       dtype=np.intp, count=len(loc_ids))
+            costs_list = cost_matrix[cluster_rows]
+
+            # Adaptive parameters based on cluster size
+            cluster_size = len(loc_ids)
+            fast_mode = cluster_size <= 4 or len(clusters) > 5  # Use fast mode for small clusters or many clusters
+            
+            if qaoa_grid_vals is not None:
+                grid = [(g, b) for g in qaoa_grid_vals for b in qaoa_grid_vals]
+            else:
+                grid = None  # Let the QAOA function decide
+                
+            logger.info(f"Using adaptive QAOA parameters (fast_mode={fast_mode})")
+
+            # Run batched QAOA for this cluster with optimizations
+            # Save circuit only for the first cluster and first location
+            save_circ = save_circuit and cluster_idx == 0
+
+            # Reuse cached results for cost vectors seen before; only the
+            # remaining locations are sent to the quantum backend.
+            cache_keys = [_qaoa_cache_key(c, shots, qaoa_p, qaoa_penalty) for c in costs_list]
+            results_by_pos: Dict[int, tuple] = {}
+            for pos, key in enumerate(cache_keys):
+                if save_circ and pos == 0:
+                    continue  # circuit saving needs a real run
+                hit = _QAOA_GRID_CACHE.get(key)
+                if hit is not None:
+                    results_by_pos[pos] = hit
+                    qaoa_cache_hits += 1
+            pending_pos = [pos for pos in range(len(costs_list)) if pos not in results_by_pos]
+
+            cluster_jobs.append({
+                "loc_ids": loc_ids,
+                "costs_list": costs_list,
+                "cache_keys": cache_keys,
+                "results_by_pos": results_by_pos,
+                "pending_pos": pending_pos,
+                "grid": grid,
+                "fast_mode": fast_mode,
+                "save_circ": save_circ,
+            })
+
+        # Phase 2: every location's QAOA is independent, so instead of one
+        # backend submission per cluster, concatenate all pending cost
+        # vectors and submit at most two global batches (fast vs slow
+        # mode). Submission and transpile-cache overhead is paid once per
+        # mode, not once per cluster.
+        for mode in (True, False):
+            batch_entries = [(job, pos)
+                             for job in cluster_jobs if job["fast_mode"] == mode
+                             for pos in job["pending_pos"]]
+            if not batch_entries:
+                continue
+            # Circuit saving is handled inside the batch call, so the first
+            # location no longer needs a separate single QAOA run
+            save_indices = {i for i, (job, pos) in enumerate(batch_entries)
+                            if job["save_circ"] and pos == 0}
+            batch_results = run_qaoa_assignment_batch(
+                costs_list=[job["costs_list"][pos] for job, pos in batch_entries],
+                backend=backend,
+                shots=shots,
+                p=qaoa_p,
+                A=qaoa_penalty,
+                grid=batch_entries[0][0]["grid"],
+                fast_mode=mode,
+                save_circuit_indices=save_indices or None
+            )
+            for (job, pos), res in zip(batch_entries, batch_results):
+                job["results_by_pos"][pos] = res
+
+        # Phase 3: fill the cache and derive counts/rankings per location
+        for job in cluster_jobs:
+            loc_ids = job["loc_ids"]
+            costs_list = job["costs_list"]
+            for pos in job["pending_pos"]:
+                if len(_QAOA_GRID_CACHE) >= _QAOA_GRID_CACHE_MAX:
+                    _QAOA_GRID_CACHE.pop(next(iter(_QAOA_GRID_CACHE)))
+                _QAOA_GRID_CACHE[job["cache_keys"][pos]] = job["results_by_pos"][pos]
+
+            batch_results = [job["results_by_pos"][pos] for pos in range(len(costs_list))]
+
+            # Dense counts matrix for the cluster; rankings come from a
+            # single axis-1 argsort instead of one sort call per location
+            C = np.zeros((len(loc_ids), num_trucks), dtype=np.int64)
+            for li, (counts_idx, _) in enumerate(batch_results):
+                for i, c in counts_idx.items():
+                    if i < num_trucks:
+                        C[li, i] = c
+            count_order = np.argsort(-C, axis=1, kind="stable")
+
+            # Populate counts and ranking from batch results
+            for li, (lid, (counts_idx, best_pair)) in enumerate(zip(loc_ids, batch_results)):
+                if include_counts:
+                    counts_by_loc_id[lid] = {vehicle_ids[i]: int(c) for i, c in counts_idx.items() if i < num_trucks}
+
+                if C[li].any():
+                    # Sort by counts (highest first)
+                    order_idx = count_order[li].tolist()
+                else:
+                    # Fallback: sort by cost (lowest first)
+                    order_idx = np.argsort(costs_list[li]).tolist()
+
+                ranking_by_loc_id[lid] = [vehicle_ids[i] for i in order_idx]
+                if log_debug:
+                    logger.debug(f"Location {lid} ranking: {ranking_by_loc_id[lid][:3]}...")  # Show top 3
+
+        logger.info("QAOA processing completed, applying constraints...")
+        
+        # Create initial assignments using balanced greedy: assign to best feasible vehicle considering capacity and current load
+        assignments: Dict[str, List[str]] = {vid: [] for vid in vehicle_ids}
+        # SoA columns indexed through loc_row_idx: scalar reads replace the
+        # per-location row-tuple map and its attribute lookups
+        loc_demand = loc_df["demand"].to_numpy(dtype=float)
+        loc_prio_scaled = loc_df["priority_scaled"].to_numpy(dtype=float)
+        loc_lat = loc_df["lat"].to_numpy(dtype=float)
+        loc_lon = loc_df["lon"].to_numpy(dtype=float)
+        max_stops = int(data.get("constraints", {}).get("max_stops_per_vehicle", 9999))
+        caps_arr = np.array([vehicles[vid].capacity for vid in vehicle_ids], dtype=float)
+        speed_arr = np.array([1.0 if vehicles[vid].type == "large" else (0.8 if vehicles[vid].type == "medium" else 0.6)
+                              for vid in vehicle_ids])
+        # Stops and carried demand per vehicle, maintained incrementally as
+        # assignments are placed; the capacity check below becomes O(1)
+        # instead of a demand sum over every assigned stop
+        stops = np.zeros(num_trucks, dtype=float)
+        demand_load = np.zeros(num_trucks, dtype=float)
+        for lid, order_ids in ranking_by_loc_id.items():
+            # Recompute costs considering current assignments to encourage distribution
+            li = loc_row_idx[lid]
+            d_lid = loc_demand[li]
+
+            # Get current costs with assignment awareness; the compiled
+            # kernel fuses the whole rescore when numba is available
+            if _greedy_score_kernel is not None:
+                current_costs = _greedy_score_kernel(
+                    depot_dist[li], caps_arr, speed_arr, stops,
+                    d_lid, loc_prio_scaled[li]
+                )
+            else:
+                location_data = {
+                    'lat': loc_lat[li],
+                    'lon': loc_lon[li],
+                    'demand': d_lid,
+                    'priority_scaled': loc_prio_scaled[li]
+                }
+                current_costs = compute_enhanced_costs(location_data, vehicles, depots, assignments,
+                                                       distance_row=depot_dist[li],
+                                                       caps=caps_arr, speed_factor=speed_arr,
+                                                       vehicle_ids=vehicle_ids)
+            
+            # Rerank vehicles by current cost (lower is better)
+            cost_ranking = np.argsort(current_costs)
+
+            chosen_vid = None
+            chosen_idx = -1
+            for idx in cost_ranking:
+                vid = vehicle_ids[idx]
+                # Check stops constraint
+                if stops[idx] >= max_stops:
+                    continue
+                # Check capacity constraint against the running load
+                if demand_load[idx] + d_lid <= caps_arr[idx] + 1e-6:
+                    chosen_vid = vid
+                    chosen_idx = idx
+                    break
+            if chosen_vid is None:
+                # Fallback to least loaded vehicle by stops
+                chosen_idx = int(np.argmin(stops))
+                chosen_vid = vehicle_ids[chosen_idx]
+            assignments[chosen_vid].append(lid)
+            stops[chosen_idx] += 1
+            demand_load[chosen_idx] += d_lid
+
+        if log_info:
+            logger.info(f"Initial assignments: {[(vid, len(locs)) for vid, locs in assignments.items()]}")
+        
+        # Enforce constraints and handle capacity/distance violations
+        assignments, unassigned = enforce_constraints(
+            assignments, ranking_by_loc_id, vehicles, depots, loc_df, 
+            data.get("constraints", {})
+        )
+        
+        if log_info:
+            logger.info(f"Final assignments after constraints: {[(vid, len(locs)) for vid, locs in assignments.items()]}")
+        if unassigned:
+            logger.warning(f"Unassigned locations: {unassigned}")
+
+        # Per-vehicle summary in one pass over the SoA demand column built
+        # earlier; no per-vehicle pandas reindex or second fill loop
+        distance_map = estimate_total_distance_km(assignments, vehicles, depots, loc_df)
+        per_vehicle_summary: Dict[str, Dict[str, float]] = {}
+        for vid, locs in assignments.items():
+            idx = np.fromiter((loc_row_idx[lid] for lid in locs), dtype=np.intp, count=len(locs))
+            per_vehicle_summary[vid] = {
+                "stops": int(len(locs)),
+                "total_demand": float(loc_demand[idx].sum()),
+                "approx_distance_km": float(round(distance_map.get(vid, 0.0), 4)),
+            }
+
+        # Build final result
+        result: Dict[str, Any] = {
+            "status": "success",
+            "method": method,
+            "meta": {
+                "num_trucks": num_trucks, 
+                "num_locations": int(len(loc_df)),
+                "shots": shots,
+                "qaoa_layers": qaoa_p,
+                "qaoa_penalty": qaoa_penalty,
+                "qaoa_cache_hits": qaoa_cache_hits,
+                "backend": backend.name if backend and hasattr(backend, 'name') else "simulator"
+            },
+            "assignments": assignments,
+            "per_vehicle_summary": per_vehicle_summary,
+            "unassigned": unassigned,
+        }
+        
+        if include_counts:
+            result["counts_by_location"] = counts_by_loc_id
+            
+        logger.info("VRP optimization completed successfully")
+        return result
+        
+    except Exception as e:
+        logger.error(f"VRP optimization failed: {str(e)}")
+        # Return error information for debugging
+        return {
+            "status": "error",
+            "message": str(e),
+            "method": method,
+            "meta": {
+                "shots": shots,
+                "backend": backend.name if backend and hasattr(backend, 'name') else "unknown"
+            }
+        }
@@ -1,448 +1,697 @@
-from __future__ import annotations
-from typing import Dict, List, Tuple, Optional
-import numpy as np
-import os
-import pickle
-import hashlib
-import datetime
-
-from qiskit import QuantumCircuit
-from qiskit_ibm_runtime import QiskitRuntimeService, SamplerV2 as Sampler
-from qiskit.transpiler.preset_passmanagers import generate_preset_pass_manager
-from qiskit.circuit import Parameter
-from qiskit.visualization import circuit_drawer
-import matplotlib.pyplot as plt
-
-
-def _compute_h_coeffs(costs: np.ndarray, A: float) -> Tuple[np.ndarray, float]:
-    """Compute QUBO coefficients for the cost function."""
-    K = len(costs)
-    h = -0.5 * (costs + A * (K - 2))
-    J = A / 2.0
-    return h, J
-
-
-def _apply_cost_layer(circuit: QuantumCircuit, qubits: List[int], gamma: float, h: np.ndarray, J: float) -> None:
-    """Apply the cost layer (problem Hamiltonian) to the circuit."""
-    # Single qubit rotations
-    for i in range(len(qubits)):
-        if abs(h[i]) > 1e-10:  # Avoid very small rotations
-            circuit.rz(2.0 * gamma * float(h[i]), qubits[i])
-    
-    # Two-qubit interactions
-    if len(qubits) >= 2 and abs(J) > 1e-10:
-        exponent = 2.0 * gamma * float(J)
-        for i in range(len(qubits)):
-            for j in range(i + 1, len(qubits)):
-                circuit.rzz(exponent, qubits[i], qubits[j])
-
-
-def _apply_mixer_layer(circuit: QuantumCircuit, qubits: List[int], beta: float) -> None:
-    """Apply the mixer layer to the circuit."""
-    for i in qubits:
-        circuit.rx(2.0 * beta, i)
-
-
-def save_circuit_visualization(circuit: QuantumCircuit, filename_base: str) -> None:
-    """Save circuit visualization as both image and text file."""
-    try:
-        # Create circuits directory if it doesn't exist
-        os.makedirs('circuits', exist_ok=True)
-        
-        # Save as image
-        img_path = f'circuits/{filename_base}.png'
-        circuit_drawer(circuit, output='mpl', filename=img_path, style='bw')
-        print(f"Circuit diagram saved to {img_path}")
-        
-        # Save as text
-        txt_path = f'circuits/{filename_base}.txt'
-        with open(txt_path, 'w') as f:
-            f.write(str(circuit))
-            f.write('\n\n')
-            f.write(f"Circuit depth: {circuit.depth()}\n")
-            f.write(f"Number of qubits: {circuit.num_qubits}\n")
-            f.write(f"Number of gates: {len(circuit.data)}\n")
-            f.write(f"Generated at: {datetime.datetime.now()}\n")
-        print(f"Circuit description saved to {txt_path}")
-        
-    except Exception as e:
-        print(f"Warning: Could not save circuit visualization: {e}")
-
-
-def build_qaoa_circuit(costs: np.ndarray, gammas: List[float], betas: List[float], A: float = 2.0, save_viz: bool = False) -> Tuple[QuantumCircuit, List[int]]:
-    """Build a QAOA circuit for the given cost function and parameters."""
-    assert len(gammas) == len(betas), "Number of gamma and beta parameters must match"
-    p = len(gammas)
-    K = len(costs)
-    qubits = list(range(K))
-    
-    # Create circuit with classical register for measurements
-    circuit = QuantumCircuit(K, K)
-
-    # Initialize uniform superposition |+>^K
-    for i in qubits:
-        circuit.h(i)
-
-    # Compute QUBO coefficients
-    h, J = _compute_h_coeffs(costs, A)
-    
-    # Apply p layers of QAOA
-    for layer in range(p):
-        _apply_cost_layer(circuit, qubits, gammas[layer], h, J)
-        _apply_mixer_layer(circuit, qubits, betas[layer])
-
-    # Add measurements
-    circuit.measure(qubits, qubits)
-    
-    # Save visualization if requested
-    if save_viz:
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"qaoa_circuit_{K}qubits_{p}layers_{timestamp}"
-        save_circuit_visualization(circuit, filename)
-    
-    return circuit, qubits
-
-
-def _bit_cost(bitstr: Tuple[int, ...], costs: np.ndarray, A: float) -> float:
-    """Compute the cost of a bit string with enhanced constraint handling."""
-    x = np.array(bitstr, dtype=float)
-    linear_cost = float(np.dot(costs, x))
-    
-    # One-hot constraint penalty
-    num_ones = np.sum(x)
-    constraint_penalty = A * (num_ones - 1.0) ** 2
-    
-    # Additional penalty for invalid assignments (all zeros or multiple ones)
-    if num_ones == 0:
-        constraint_penalty += A * 2.0  # Extra penalty for no assignment
-    elif num_ones > 1:
-        constraint_penalty += A * 0.5  # Moderate penalty for multiple assignments
-    
-    return linear_cost + constraint_penalty
-
-
-def _energy_from_counts(counts: Dict[str, int], costs: np.ndarray, A: float, shots: int) -> float:
-    """Compute average energy from measurement counts."""
-    if shots <= 0:
-        return 0.0
-    
-    total_energy = 0.0
-    for bitstr, count in counts.items():
-        # Convert bit string to tuple (reverse for little-endian)
-        bit_tuple = tuple(int(b) for b in bitstr[::-1])
-        cost = _bit_cost(bit_tuple, costs, A)
-        total_energy += cost * count
-    
-    return total_energy / float(shots)
-
-
-def _measure_counts(circuit: QuantumCircuit, backend, K: int, shots: int) -> Dict[str, int]:
-    """Run the circuit on IBM Quantum backend and return counts."""
-    try:
-        # Transpile circuit for the backend
-        pm = generate_preset_pass_manager(backend=backend, optimization_level=1)
-        transpiled_circuit = pm.run(circuit)
-        
-        # Use SamplerV2 for execution
-        sampler = Sampler(backend)
-        
-        # Run the job
-        job = sampler.run([transpiled_circuit], shots=shots)
-        result = job.result()
-        
-        # Extract counts from the result
-        if hasattr(result[0].data, 'meas'):
-            # Get the measurement data
-            meas_data = result[0].data.meas
-            
-            # Convert to counts dictionary
-            counts = {}
-            for measurement in meas_data:
-                # Convert measurement array to bit string
-                bitstr = ''.join(str(int(bit)) for bit in measurement)
-                counts[bitstr] = counts.get(bitstr, 0) + 1
-            
-            return counts
-        else:
-            # Fallback: uniform random distribution
-            print("Warning: No measurement data found, using uniform distribution")
-            counts = {}
-            for i in range(min(2**K, 100)):  # Limit to avoid memory issues
-                bitstr = format(i, f'0{K}b')
-                counts[bitstr] = shots // min(2**K, 100)
-            return counts
-            
-    except Exception as e:
-        print(f"Error running circuit: {e}")
-        # Fallback: return uniform distribution
-        counts = {}
-        for i in range(min(2**K, 100)):
-            bitstr = format(i, f'0{K}b')
-            counts[bitstr] = shots // min(2**K, 100)
-        return counts
-
-
-def get_adaptive_grid(costs: np.ndarray, fast_mode: bool = False) -> List[Tuple[float, float]]:
-    """Get adaptive parameter grid based on problem size and mode."""
-    K = len(costs)
-    
-    if fast_mode or K <= 4:
-        # Fast mode: small focused grid
-        gamma_vals = [0.2, 0.5, 0.8]
-        beta_vals = [0.3, 0.6, 0.9]
-    elif K <= 8:
-        # Medium grid for small problems
-        gamma_vals = [0.1, 0.4, 0.7, 1.0]
-        beta_vals = [0.2, 0.5, 0.8, 1.1]
-    else:
-        # Minimal grid for large problems
-        gamma_vals = [0.3, 0.6]
-        beta_vals = [0.4, 0.7]
-    
-    return [(g, b) for g in gamma_vals for b in beta_vals]
-
-
-def get_circuit_cache_key(costs: np.ndarray, A: float, p: int) -> str:
-    """Generate cache key for circuit parameters."""
-    # Create a hash based on costs, A, and p
-    cost_str = ','.join([f'{c:.6f}' for c in costs])
-    key_str = f"{cost_str}_{A:.3f}_{p}"
-    return hashlib.md5(key_str.encode()).hexdigest()
-
-
-def load_cached_result(cache_key: str) -> Optional[Tuple[Dict[int, int], Tuple[float, float]]]:
-    """Load cached QAOA result if available."""
-    try:
-        cache_dir = 'qaoa_cache'
-        os.makedirs(cache_dir, exist_ok=True)
-        cache_file = f'{cache_dir}/{cache_key}.pkl'
-        
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as f:
-                return pickle.load(f)
-    except Exception:
-        pass
-    return None
-
-
-def save_cached_result(cache_key: str, result: Tuple[Dict[int, int], Tuple[float, float]]) -> None:
-    """Save QAOA result to cache."""
-    try:
-        cache_dir = 'qaoa_cache'
-        os.makedirs(cache_dir, exist_ok=True)
-        cache_file = f'{cache_dir}/{cache_key}.pkl'
-        
-        with open(cache_file, 'wb') as f:
-            pickle.dump(result, f)
-    except Exception as e:
-        print(f"Warning: Could not cache result: {e}")
-
-
-def run_qaoa_assignment(costs: np.ndarray, backend, shots: int = 2000, p: int = 1, A: float = 3.0,
-                        grid: Optional[List[Tuple[float, float]]] = None, fast_mode: bool = False, 
-                        save_circuit: bool = False) -> Tuple[Dict[int, int], Tuple[float, float]]:
-    """
-    Run QAOA with grid search over (gamma, beta) parameters for one-hot assignment.
-    
-    Args:
-        costs: Array of costs for each option
-        backend: IBM Quantum backend
-        shots: Number of shots per parameter combination
-        p: Number of QAOA layers
-        A: Penalty parameter for one-hot constraint
-        grid: List of (gamma, beta) parameter pairs to try
-    
-    Returns:
-        Tuple of (assignment counts by index, best parameter pair)
-    """
-    K = len(costs)
-    
-    # Check cache first
-    cache_key = get_circuit_cache_key(costs, A, p)
-    cached_result = load_cached_result(cache_key)
-    if cached_result is not None and not save_circuit:  # Skip cache if we want to save circuit
-        print(f"Using cached QAOA result for {K}-qubit problem")
-        return cached_result
-    
-    # Get adaptive grid based on problem size and mode
-    if grid is None:
-        grid = get_adaptive_grid(costs, fast_mode)
-    
-    print(f"Running QAOA with {len(grid)} parameter combinations (fast_mode={fast_mode})")
-    
-    best_E = float("inf")
-    best_counts: Dict[str, int] = {}
-    best_pair = (0.3, 0.7)
-
-    # Build circuits with optional visualization
-    circuits = []
-    for i, (g, b) in enumerate(grid):
-        gammas = [g] * p
-        betas = [b] * p
-        # Save circuit visualization only for the first parameter combination
-        save_viz = save_circuit and i == 0
-        circ, _ = build_qaoa_circuit(costs=costs, gammas=gammas, betas=betas, A=A, save_viz=save_viz)
-        circuits.append(circ)
-
-    # Transpile all circuits
-    pm = generate_preset_pass_manager(backend=backend, optimization_level=1)
-    transpiled_circuits = [pm.run(circ) for circ in circuits]
-
-    # Execute batch job
-    sampler = Sampler(backend)
-    job = sampler.run(transpiled_circuits, shots=shots)
-    results = job.result()
-    print("Batch execution completed for grid search.")
-
-    # Evaluate energies and select best parameters
-    for idx, (g, b) in enumerate(grid):
-        data = results[idx].data
-        # Extract counts
-        if hasattr(data, 'meas'):
-            meas_list = data.meas
-            counts: Dict[str, int] = {}
-            for meas in meas_list:
-                bitstr = ''.join(str(int(bit)) for bit in meas)
-                counts[bitstr] = counts.get(bitstr, 0) + 1
-        else:
-            # Fallback uniform distribution
-            counts = {format(i, f'0{K}b'): shots // min(2**K, 100) for i in range(min(2**K, 100))}
-
-        E = _energy_from_counts(counts, costs, A, shots)
-        print(f"Parameters ({g}, {b}) produced energy {E:.4f}")
-        if E < best_E:
-            best_E = E
-            best_counts = counts
-            best_pair = (g, b)
-            print(f"New best parameters: ({g}, {b}) with energy {E:.4f}")
-
-    print(f"Best parameters: {best_pair}, Best energy: {best_E:.4f}")
-
-    # Convert to assignment counts by index with improved handling
-    counts_by_index: Dict[int, int] = {}
-    valid_shots = 0
-    invalid_shots = 0
-    
-    for bitstr, count in best_counts.items():
-        # Convert to bit tuple (reverse for little-endian)
-        bit_tuple = tuple(int(b) for b in bitstr[::-1])
-        ones = [i for i, v in enumerate(bit_tuple) if v == 1]
-        
-        # Handle different assignment patterns
-        if len(ones) == 1:
-            # Valid one-hot assignment
-            idx = ones[0]
-            counts_by_index[idx] = counts_by_index.get(idx, 0) + count
-            valid_shots += count
-        elif len(ones) == 0:
-            # No assignment - distribute proportionally to inverse cost
-            inv_costs = 1.0 / (costs + 1e-6)  # Avoid division by zero
-            prob_weights = inv_costs / np.sum(inv_costs)
-            for i, weight in enumerate(prob_weights):
-                counts_by_index[i] = counts_by_index.get(i, 0) + int(count * weight)
-            invalid_shots += count
-        else:
-            # Multiple assignments - give to the one with lowest cost among selected
-            best_among_ones = min(ones, key=lambda i: costs[i])
-            counts_by_index[best_among_ones] = counts_by_index.get(best_among_ones, 0) + count
-            invalid_shots += count
-
-    # If no valid assignments at all, use cost-based distribution
-    if not counts_by_index or sum(counts_by_index.values()) == 0:
-        print("Warning: No valid assignments found, using cost-based distribution")
-        inv_costs = 1.0 / (costs + 1e-6)
-        prob_weights = inv_costs / np.sum(inv_costs)
-        for i, weight in enumerate(prob_weights):
-            counts_by_index[i] = max(1, int(shots * weight))
-    
-    print(f"Assignment quality: {valid_shots}/{shots} valid shots, {invalid_shots} corrected")
-
-    print(f"Final assignment distribution: {counts_by_index}")
-    
-    # Cache the result
-    result = (counts_by_index, best_pair)
-    save_cached_result(cache_key, result)
-    
-    return result
-
-
-def run_qaoa_assignment_batch(costs_list: List[np.ndarray], backend, shots: int = 2000, p: int = 1, A: float = 3.0,
-                              grid: Optional[List[Tuple[float, float]]] = None, fast_mode: bool = False) -> List[Tuple[Dict[int, int], Tuple[float, float]]]:
-    """
-    Run QAOA for multiple cost vectors (one per location) in a single batched job.
-
-    Returns a list of tuples (counts_by_index, best_pair) in the same order as costs_list.
-    """
-    # Use adaptive grid for all locations (take average problem size)
-    if grid is None:
-        avg_size = sum(len(c) for c in costs_list) / len(costs_list)
-        dummy_costs = np.zeros(int(avg_size))
-        grid = get_adaptive_grid(dummy_costs, fast_mode)
-    
-    print(f"Batch QAOA with {len(grid)} parameter combinations, fast_mode={fast_mode}")
-
-    K_list = [len(c) for c in costs_list]
-
-    # Build all circuits (one circuit per (location, grid_param))
-    circuits = []
-    mapping = []  # (loc_idx, grid_idx)
-    for loc_idx, costs in enumerate(costs_list):
-        for grid_idx, (g, b) in enumerate(grid):
-            gammas = [g] * p
-            betas = [b] * p
-            circ, _ = build_qaoa_circuit(costs=costs, gammas=gammas, betas=betas, A=A)
-            circuits.append(circ)
-            mapping.append((loc_idx, grid_idx))
-
-    # Transpile and run all circuits in one batch request
-    pm = generate_preset_pass_manager(backend=backend, optimization_level=1)
-    transpiled = [pm.run(c) for c in circuits]
-    sampler = Sampler(backend)
-    job = sampler.run(transpiled, shots=shots)
-    results = job.result()
-
-    # Aggregate per-location best results
-    per_location_outputs: List[Tuple[Dict[int, int], Tuple[float, float]]] = []
-    for loc_idx, costs in enumerate(costs_list):
-        best_E = float("inf")
-        best_counts: Dict[str, int] = {}
-        best_pair = (0.3, 0.7)
-
-        # Iterate over grid results for this location
-        for i, (m_loc, m_grid) in enumerate(mapping):
-            if m_loc != loc_idx:
-                continue
-            data = results[i].data
-            if hasattr(data, 'meas'):
-                meas_list = data.meas
-                counts: Dict[str, int] = {}
-                for meas in meas_list:
-                    bitstr = ''.join(str(int(bit)) for bit in meas)
-                    counts[bitstr] = counts.get(bitstr, 0) + 1
-            else:
-                counts = {format(i2, f'0{len(costs)}b'): shots // min(2**len(costs), 100) for i2 in range(min(2**len(costs), 100))}
-
-            E = _energy_from_counts(counts, costs, A, shots)
-            if E < best_E:
-                best_E = E
-                best_counts = counts
-                best_pair = grid[m_grid]
-
-        # Convert best_counts to index counts similar to single-run function
-        counts_by_index: Dict[int, int] = {}
-        valid_shots = 0
-        for bitstr, cnt in best_counts.items():
-            bit_tuple = tuple(int(b) for b in bitstr[::-1])
-            ones = [j for j, v in enumerate(bit_tuple) if v == 1]
-            if len(ones) == 1:
-                idx = ones[0]
-                counts_by_index[idx] = counts_by_index.get(idx, 0) + cnt
-                valid_shots += cnt
-
-        if not counts_by_index or valid_shots == 0:
-            idx = int(np.argmin(costs))
-            counts_by_index = {idx: shots}
-
-        per_location_outputs.append((counts_by_index, best_pair))
-
+from __future__ import annotations
+from typing import Dict, List, Tuple, Optional, Set
+import numpy as np
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import combinations
+import hashlib
+import struct
+import datetime
+
+from qiskit import QuantumCircuit
+from qiskit_ibm_runtime import QiskitRuntimeService, SamplerV2 as Sampler
+from qiskit.transpiler.preset_passmanagers import generate_preset_pass_manager
+from qiskit.circuit import Parameter, ParameterVector
+from qiskit.circuit.library import RXGate, RZGate, RZZGate
+from qiskit.visualization import circuit_drawer
+import matplotlib
+# Headless raster backend: diagrams render on a background thread inside a
+# server process, where a GUI backend is unsafe and accumulates state
+matplotlib.use("Agg")
+
+# Optional: numba JIT-compiles the 2^K cost-table enumeration; the NumPy
+# broadcast fallback below is used when it is not installed.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Optional: diskcache keeps all cached QAOA results in one SQLite-backed
+# store with atomic transactions and LRU eviction, so hits skip the
+# makedirs/exists/open syscall path of the per-key pickle files below.
+try:
+    from diskcache import Cache as _DiskCache
+    _RESULT_CACHE = _DiskCache('qaoa_cache', size_limit=2 ** 30)
+except ImportError:
+    _RESULT_CACHE = None
+
+# Pickle-file fallback cache directory, created once at import instead of
+# a makedirs (stat syscall) on every cache lookup
+_CACHE_DIR = 'qaoa_cache'
+if _RESULT_CACHE is None:
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+
+# Preset pass managers cached per backend instance: construction assembles
+# the full plugin pass set, which is wasted work on repeated calls against
+# the same target.
+_PM_CACHE: Dict[Tuple[int, int], object] = {}
+
+
+def _pm_for(backend, level: int = 1) -> object:
+    """Preset pass manager for a backend, built once per (backend, level)."""
+    key = (id(backend), level)
+    pm = _PM_CACHE.get(key)
+    if pm is None:
+        pm = generate_preset_pass_manager(backend=backend, optimization_level=level)
+        _PM_CACHE[key] = pm
+    return pm
+
+
+if njit is not None:
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _cdiag_kernel(costs: np.ndarray, A: float, K: int, include_invalid: bool) -> np.ndarray:  # pragma: no cover
+        out = np.empty(1 << K)
+        for b in prange(1 << K):
+            s = 0.0
+            p = 0
+            for i in range(K):
+                bit = (b >> i) & 1
+                s += costs[i] * bit
+                p += bit
+            s += A * (p - 1.0) ** 2
+            if include_invalid:
+                if p == 0:
+                    s += A * 2.0
+                elif p > 1:
+                    s += A * 0.5
+            out[b] = s
+        return out
+
+
+def _compute_h_coeffs(costs: np.ndarray, A: float) -> Tuple[np.ndarray, float]:
+    """Compute QUBO coefficients for the cost function.
+
+    Memoized on the raw cost bytes: batched runs frequently repeat identical
+    cost vectors across locations, and callers only read the returned array.
+    """
+    return _h_coeffs_cached(np.ascontiguousarray(costs, dtype=np.float64).tobytes(),
+                            len(costs), float(A))
+
+
+@lru_cache(maxsize=1024)
+def _h_coeffs_cached(costs_bytes: bytes, K: int, A: float) -> Tuple[np.ndarray, float]:
+    costs = np.frombuffer(costs_bytes, dtype=np.float64)
+    # Only the -0.5*costs term varies per location; fold the constant offset
+    # in-place so each call allocates a single array
+    h = costs * -0.5
+    h -= 0.5 * A * (K - 2)
+    J = A / 2.0
+    return h, J
+
+
+def _apply_cost_layer(circuit: QuantumCircuit, qubits: List[int], gamma: float, h: np.ndarray, J: float) -> None:
+    """Apply the cost layer (problem Hamiltonian) to the circuit."""
+    append = circuit.append
+
+    # Hoist the common 2*gamma factor and convert h to native floats once,
+    # instead of a numpy-scalar cast and two multiplies per qubit per layer
+    two_gamma = 2.0 * gamma
+    h_list = np.asarray(h, dtype=np.float64).tolist()
+
+    # Single qubit rotations
+    for q, hi in zip(qubits, h_list):
+        if abs(hi) > 1e-10:  # Avoid very small rotations
+            append(RZGate(two_gamma * hi), (q,), ())
+
+    # Two-qubit interactions: every pair shares the same angle, so one gate
+    # instance is appended K*(K-1)/2 times instead of constructing a fresh
+    # gate object per pair; combinations enumerates the pairs in C.
+    if len(qubits) >= 2 and abs(J) > 1e-10:
+        zz = RZZGate(two_gamma * float(J))
+        for a, b in combinations(qubits, 2):
+            append(zz, (a, b), ())
+
+
+def _apply_mixer_layer(circuit: QuantumCircuit, qubits: List[int], beta: float) -> None:
+    """Apply the mixer layer to the circuit."""
+    rx = RXGate(2.0 * beta)
+    append = circuit.append
+    for i in qubits:
+        append(rx, (i,), ())
+
+
+# Single background worker for circuit rendering: matplotlib drawing takes
+# hundreds of ms and has no bearing on the compute path, so callers submit
+# a copy of the circuit and return immediately.
+_VIZ_POOL = ThreadPoolExecutor(max_workers=1)
+
+
+def save_circuit_visualization_async(circuit: QuantumCircuit, filename_base: str) -> None:
+    """Queue circuit rendering off the critical path."""
+    _VIZ_POOL.submit(save_circuit_visualization, circuit.copy(), filename_base)
+
+
+def save_circuit_visualization(circuit: QuantumCircuit, filename_base: str) -> None:
+    """Save circuit visualization as both image and text file."""
+    try:
+        # Create circuits directory if it doesn't exist
+        os.makedirs('circuits', exist_ok=True)
+        
+        # Save as image; render into a temp file and swap it in atomically so
+        # readers never see a half-written PNG while the worker is drawing
+        img_path = f'circuits/{filename_base}.png'
+        img_tmp = f'circuits/{filename_base}.tmp.png'
+        circuit_drawer(circuit, output='mpl', filename=img_tmp, style='bw')
+        os.replace(img_tmp, img_path)
+        print(f"Circuit diagram saved to {img_path}")
+
+        # Save as text, with the same atomic swap
+        txt_path = f'circuits/{filename_base}.txt'
+        with open(f'{txt_path}.tmp', 'w') as f:
+            f.write(str(circuit))
+            f.write('\n\n')
+            f.write(f"Circuit depth: {circuit.depth()}\n")
+            f.write(f"Number of qubits: {circuit.num_qubits}\n")
+            f.write(f"Number of gates: {len(circuit.data)}\n")
+            f.write(f"Generated at: {datetime.datetime.now()}\n")
+        os.replace(f'{txt_path}.tmp', txt_path)
+        print(f"Circuit description saved to {txt_path}")
+        
+    except Exception as e:
+        print(f"Warning: Could not save circuit visualization: {e}")
+
+
+def build_qaoa_circuit(costs: np.ndarray, gammas: List[float], betas: List[float], A: float = 2.0, save_viz: bool = False,
+                       measure: bool = True, coeffs: Optional[Tuple[np.ndarray, float]] = None) -> Tuple[QuantumCircuit, List[int]]:
+    """Build a QAOA circuit for the given cost function and parameters.
+
+    coeffs may carry precomputed (h, J) so grid-search callers building many
+    circuits for the same costs skip the redundant recomputation.
+    """
+    assert len(gammas) == len(betas), "Number of gamma and beta parameters must match"
+    p = len(gammas)
+    K = len(costs)
+    qubits = list(range(K))
+
+    # Create circuit with classical register for measurements
+    circuit = QuantumCircuit(K, K)
+
+    # Initialize uniform superposition |+>^K
+    for i in qubits:
+        circuit.h(i)
+
+    # Compute QUBO coefficients
+    h, J = coeffs if coeffs is not None else _compute_h_coeffs(costs, A)
+
+    # Apply p layers of QAOA
+    for layer in range(p):
+        _apply_cost_layer(circuit, qubits, gammas[layer], h, J)
+        _apply_mixer_layer(circuit, qubits, betas[layer])
+
+    # Add measurements (skipped for exact state-vector evaluation)
+    if measure:
+        circuit.measure(qubits, qubits)
+
+    # Save visualization if requested
+    if save_viz:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"qaoa_circuit_{K}qubits_{p}layers_{timestamp}"
+        save_circuit_visualization_async(circuit, filename)
+
+    return circuit, qubits
+
+
+def build_qaoa_template(costs: np.ndarray, p: int, A: float = 2.0, measure: bool = False) -> Tuple[QuantumCircuit, Parameter, Parameter]:
+    """Build a parameterized QAOA circuit skeleton with symbolic (gamma, beta).
+
+    The grid search binds concrete values per point via assign_parameters,
+    so the circuit (and its O(K^2) two-qubit layer) is constructed only once.
+    """
+    K = len(costs)
+    qubits = list(range(K))
+    gamma = Parameter("gamma")
+    beta = Parameter("beta")
+
+    circuit = QuantumCircuit(K, K)
+    for i in qubits:
+        circuit.h(i)
+
+    h, J = _compute_h_coeffs(costs, A)
+    for _ in range(p):
+        _apply_cost_layer(circuit, qubits, gamma, h, J)
+        _apply_mixer_layer(circuit, qubits, beta)
+
+    if measure:
+        circuit.measure(qubits, qubits)
+
+    return circuit, gamma, beta
+
+
+def build_qaoa_param_template(K: int, p: int) -> Tuple[QuantumCircuit, ParameterVector, Parameter, Parameter]:
+    """Fully parameterized QAOA skeleton for K qubits, including the costs.
+
+    The rotation angles absorb the QUBO coefficients (th[i] = 2*gamma*h[i],
+    ph = 2*gamma*J, bt = 2*beta), so a single transpiled template serves
+    every (location, grid-point) pair at this K.
+    """
+    th = ParameterVector("th", K)
+    ph = Parameter("ph")
+    bt = Parameter("bt")
+
+    circuit = QuantumCircuit(K, K)
+    for i in range(K):
+        circuit.h(i)
+    for _ in range(p):
+        for i in range(K):
+            circuit.rz(th[i], i)
+        for i in range(K):
+            for j in range(i + 1, K):
+                circuit.rzz(ph, i, j)
+        for i in range(K):
+            circuit.rx(bt, i)
+    circuit.measure(range(K), range(K))
+    return circuit, th, ph, bt
+
+
+def _cost_diagonal(costs: np.ndarray, A: float, include_invalid_penalties: bool = True) -> np.ndarray:
+    """Precompute the diagonal of the cost Hamiltonian over all 2^K basis states.
+
+    Entry x holds the same value `_bit_costs` would compute for the bit pattern
+    of x (qubit i = bit i of x, matching Qiskit's little-endian convention).
+    With include_invalid_penalties=False the diagonal matches the pure QUBO
+    encoded by the circuit (used as the phase function during evolution).
+    """
+    K = len(costs)
+    if njit is not None:
+        return _cdiag_kernel(np.ascontiguousarray(costs, dtype=np.float64),
+                             float(A), K, include_invalid_penalties)
+    bits = ((np.arange(2 ** K)[:, None] >> np.arange(K)) & 1).astype(np.float64)
+    ones = bits.sum(axis=1)
+    cdiag = bits @ costs + A * (ones - 1.0) ** 2
+    if include_invalid_penalties:
+        # Mirror the extra penalties from _bit_costs for invalid assignments
+        cdiag += np.where(ones == 0, A * 2.0, 0.0)
+        cdiag += np.where(ones > 1, A * 0.5, 0.0)
+    return cdiag
+
+
+def _qaoa_probs(phase_diag: np.ndarray, gammas: List[float], betas: List[float], K: int) -> np.ndarray:
+    """Evolve the QAOA state with plain NumPy and return |psi|^2.
+
+    The cost Hamiltonian is diagonal, so each cost layer is one elementwise
+    phase multiplication; the mixer is K independent single-qubit Rx gates
+    applied via axis views of the (2,)*K-shaped state. This bypasses circuit
+    construction and simulation entirely for the grid search.
+    """
+    psi = np.full(2 ** K, 1.0 / np.sqrt(2 ** K), dtype=np.complex64)
+    for gamma, beta in zip(gammas, betas):
+        # Keep every factor complex64 so no intermediate silently promotes
+        # the state to double precision (the kernel is bandwidth-bound).
+        psi = psi * np.exp(phase_diag * np.complex64(-1j * gamma))
+        # Rx(2*beta) on every qubit: [[cos b, -i sin b], [-i sin b, cos b]]
+        c = np.complex64(np.cos(beta))
+        s = np.complex64(-1j * np.sin(beta))
+        psi = psi.reshape((2,) * K)
+        for axis in range(K):
+            a = np.moveaxis(psi, axis, 0)
+            a0 = a[0].copy()
+            a[0] = c * a0 + s * a[1]
+            a[1] = s * a0 + c * a[1]
+        psi = psi.reshape(-1)
+    return np.abs(psi) ** 2
+
+
+def _bit_costs(bits: np.ndarray, costs: np.ndarray, A: float) -> np.ndarray:
+    """Compute the cost of every row of an (N, K) bit matrix in one pass."""
+    x = bits.astype(np.float64, copy=False)
+    linear_cost = x @ costs
+
+    # One-hot constraint penalty
+    ones = x.sum(axis=1)
+    constraint_penalty = A * (ones - 1.0) ** 2
+
+    # Additional penalty for invalid assignments (all zeros or multiple ones)
+    constraint_penalty += np.where(ones == 0, A * 2.0, 0.0)  # Extra penalty for no assignment
+    constraint_penalty += np.where(ones > 1, A * 0.5, 0.0)   # Moderate penalty for multiple assignments
+
+    return linear_cost + constraint_penalty
+
+
+def _bits_from_codes(codes: np.ndarray, K: int) -> np.ndarray:
+    """Expand packed uint64 outcome codes into an (N, K) int8 bit matrix.
+
+    Bit columns follow qubit order (bit i of a code is qubit i).
+    """
+    return ((codes[:, None] >> np.arange(K, dtype=np.uint64)) & 1).astype(np.int8)
+
+
+def _counts_codes_from_meas(meas_data, K: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Histogram raw per-shot measurements into (codes, weights) arrays.
+
+    Each shot row is packed into a uint64 code (bit i = qubit i) and the
+    distinct outcomes counted with one np.unique over the flat integer
+    array — no per-shot Python loop and no bitstring allocation at all.
+
+    Row element 0 holds the highest qubit (the order the former bitstring
+    path reversed before indexing), so columns are flipped before packing
+    to keep bit i of a code aligned with qubit i.
+    """
+    arr = np.asarray(meas_data, dtype=np.uint8).reshape(-1, K)
+    weights = (np.uint64(1) << np.arange(K, dtype=np.uint64))
+    codes = arr[:, ::-1].astype(np.uint64) @ weights
+    uniq_codes, cnts = np.unique(codes, return_counts=True)
+    return uniq_codes, cnts.astype(np.int64)
+
+
+def _energy_from_codes(codes: np.ndarray, weights: np.ndarray, costs: np.ndarray, A: float, shots: int) -> float:
+    """Compute average energy from an outcome-code histogram."""
+    if shots <= 0 or codes.size == 0:
+        return 0.0
+
+    bits = _bits_from_codes(codes, len(costs))
+    return float(_bit_costs(bits, costs, A) @ weights.astype(np.float64)) / float(shots)
+
+
+def _uniform_fallback(K: int, shots: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Uniform (codes, weights) histogram used when no measurement data exists.
+
+    Capped at 100 outcomes to avoid materializing 2^K entries for larger K.
+    """
+    n = min(2 ** K, 100)
+    return np.arange(n, dtype=np.uint64), np.full(n, shots // n, dtype=np.int64)
+
+
+def _measure_counts(circuit: QuantumCircuit, backend, K: int, shots: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Run the circuit on IBM Quantum backend and return (codes, weights)."""
+    try:
+        # Transpile circuit for the backend
+        pm = _pm_for(backend)
+        transpiled_circuit = pm.run(circuit)
+
+        # Use SamplerV2 for execution
+        sampler = Sampler(backend)
+
+        # Run the job
+        job = sampler.run([transpiled_circuit], shots=shots)
+        result = job.result()
+
+        # Extract counts from the result
+        if hasattr(result[0].data, 'meas'):
+            # Aggregate the measurement data in one vectorized pass
+            return _counts_codes_from_meas(result[0].data.meas, K)
+        else:
+            # Fallback: uniform random distribution
+            print("Warning: No measurement data found, using uniform distribution")
+            return _uniform_fallback(K, shots)
+
+    except Exception as e:
+        print(f"Error running circuit: {e}")
+        # Fallback: return uniform distribution
+        return _uniform_fallback(K, shots)
+
+
+def get_adaptive_grid(costs: np.ndarray, fast_mode: bool = False) -> List[Tuple[float, float]]:
+    """Get adaptive parameter grid based on problem size and mode."""
+    return _adaptive_grid_cached(len(costs), fast_mode)
+
+
+@lru_cache(maxsize=64)
+def _adaptive_grid_cached(K: int, fast_mode: bool) -> List[Tuple[float, float]]:
+    # The grid depends only on (K, fast_mode); callers treat it as read-only
+    if fast_mode or K <= 4:
+        # Fast mode: small focused grid
+        gamma_vals = [0.2, 0.5, 0.8]
+        beta_vals = [0.3, 0.6, 0.9]
+    elif K <= 8:
+        # Medium grid for small problems
+        gamma_vals = [0.1, 0.4, 0.7, 1.0]
+        beta_vals = [0.2, 0.5, 0.8, 1.1]
+    else:
+        # Minimal grid for large problems
+        gamma_vals = [0.3, 0.6]
+        beta_vals = [0.4, 0.7]
+    
+    return [(g, b) for g in gamma_vals for b in beta_vals]
+
+
+def get_circuit_cache_key(costs: np.ndarray, A: float, p: int) -> str:
+    """Generate cache key for circuit parameters."""
+    # Hash the raw rounded bytes instead of formatting every cost into a
+    # decimal string first; blake2b is the fastest digest in _hashlib and
+    # this key is not security-sensitive
+    buf = np.round(costs, 6).astype('<f4').tobytes() + struct.pack('<fI', A, p)
+    return hashlib.blake2b(buf, digest_size=16).hexdigest()
+
+
+def load_cached_result(cache_key: str) -> Optional[Tuple[Dict[int, int], Tuple[float, float]]]:
+    """Load cached QAOA result if available."""
+    if _RESULT_CACHE is not None:
+        return _RESULT_CACHE.get(cache_key)
+    try:
+        cache_file = f'{_CACHE_DIR}/{cache_key}.pkl'
+        
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+    except Exception:
+        pass
+    return None
+
+
+def save_cached_result(cache_key: str, result: Tuple[Dict[int, int], Tuple[float, float]]) -> None:
+    """Save QAOA result to cache."""
+    if _RESULT_CACHE is not None:
+        try:
+            _RESULT_CACHE.set(cache_key, result)
+        except Exception as e:
+            print(f"Warning: Could not cache result: {e}")
+        return
+    try:
+        cache_file = f'{_CACHE_DIR}/{cache_key}.pkl'
+
+        with open(cache_file, 'wb') as f:
+            # Binary protocol 5 pickles the counts dict far more compactly
+            # than the default; load() detects the protocol automatically
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print(f"Warning: Could not cache result: {e}")
+
+
+def run_qaoa_assignment(costs: np.ndarray, backend, shots: int = 2000, p: int = 1, A: float = 3.0,
+                        grid: Optional[List[Tuple[float, float]]] = None, fast_mode: bool = False, 
+                        save_circuit: bool = False) -> Tuple[Dict[int, int], Tuple[float, float]]:
+    """
+    Run QAOA with grid search over (gamma, beta) parameters for one-hot assignment.
+    
+    Args:
+        costs: Array of costs for each option
+        backend: IBM Quantum backend
+        shots: Number of shots per parameter combination
+        p: Number of QAOA layers
+        A: Penalty parameter for one-hot constraint
+        grid: List of (gamma, beta) parameter pairs to try
+    
+    Returns:
+        Tuple of (assignment counts by index, best parameter pair)
+    """
+    K = len(costs)
+    
+    # Check cache first
+    cache_key = get_circuit_cache_key(costs, A, p)
+    cached_result = load_cached_result(cache_key)
+    if cached_result is not None and not save_circuit:  # Skip cache if we want to save circuit
+        print(f"Using cached QAOA result for {K}-qubit problem")
+        return cached_result
+    
+    # Get adaptive grid based on problem size and mode
+    if grid is None:
+        grid = get_adaptive_grid(costs, fast_mode)
+    
+    print(f"Running QAOA with {len(grid)} parameter combinations (fast_mode={fast_mode})")
+
+    best_E = float("inf")
+    best_pair = (0.3, 0.7)
+
+    # Grid search via exact diagonal expectation on the state vector: the cost
+    # Hamiltonian is diagonal, so <C> is computed analytically per (gamma, beta)
+    # without spending any shots or adding sampling noise.
+    cdiag = _cost_diagonal(costs, A)
+    phase_diag = _cost_diagonal(costs, A, include_invalid_penalties=False).astype(np.float32)
+    if save_circuit:
+        template, _, _ = build_qaoa_template(costs, p, A)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        save_circuit_visualization_async(template, f"qaoa_circuit_{K}qubits_{p}layers_{timestamp}")
+    for g, b in grid:
+        probs = _qaoa_probs(phase_diag, [g] * p, [b] * p, K)
+        E = float(probs @ cdiag)
+        print(f"Parameters ({g}, {b}) produced energy {E:.4f}")
+        if E < best_E:
+            best_E = E
+            best_pair = (g, b)
+            print(f"New best parameters: ({g}, {b}) with energy {E:.4f}")
+
+    print(f"Best parameters: {best_pair}, Best energy: {best_E:.4f}")
+
+    # Sample only the winning parameter pair on the backend, spending the full
+    # shot budget where the counts are actually needed by the caller.
+    best_circ, _ = build_qaoa_circuit(costs=costs, gammas=[best_pair[0]] * p, betas=[best_pair[1]] * p, A=A)
+    codes, w = _measure_counts(best_circ, backend, K, shots)
+
+    # Convert to assignment counts by index: expand the outcome codes into
+    # one (N, K) bit matrix and classify every outcome with masks
+    bits = _bits_from_codes(codes, K)
+    w = w.astype(np.float64)
+    ones = bits.sum(axis=1)
+    valid = ones == 1
+    zero = ones == 0
+    multi = ones > 1
+    tally = np.zeros(K, dtype=np.float64)
+    if valid.any():
+        # Valid one-hot assignments go to their set qubit
+        tally += np.bincount(bits[valid].argmax(axis=1), weights=w[valid], minlength=K)
+    if zero.any():
+        # No assignment - distribute proportionally to inverse cost
+        inv_costs = 1.0 / (costs + 1e-6)  # Avoid division by zero
+        prob_weights = inv_costs / np.sum(inv_costs)
+        tally += (w[zero].sum() * prob_weights).astype(np.int64)
+    if multi.any():
+        # Multiple assignments - give to the one with lowest cost among selected
+        best_among = np.where(bits[multi] == 1, costs, np.inf).argmin(axis=1)
+        tally += np.bincount(best_among, weights=w[multi], minlength=K)
+    valid_shots = int(w[valid].sum())
+    invalid_shots = int(w[zero].sum() + w[multi].sum())
+    counts_by_index: Dict[int, int] = {i: int(c) for i, c in enumerate(tally) if c > 0}
+
+    # If no valid assignments at all, use cost-based distribution
+    if not counts_by_index or sum(counts_by_index.values()) == 0:
+        print("Warning: No valid assignments found, using cost-based distribution")
+        inv_costs = 1.0 / (costs + 1e-6)
+        prob_weights = inv_costs / np.sum(inv_costs)
+        for i, weight in enumerate(prob_weights):
+            counts_by_index[i] = max(1, int(shots * weight))
+    
+    print(f"Assignment quality: {valid_shots}/{shots} valid shots, {invalid_shots} corrected")
+
+    print(f"Final assignment distribution: {counts_by_index}")
+    
+    # Cache the result
+    result = (counts_by_index, best_pair)
+    save_cached_result(cache_key, result)
+    
+    return result
+
+
+def run_qaoa_assignment_batch(costs_list: List[np.ndarray], backend, shots: int = 2000, p: int = 1, A: float = 3.0,
+                              grid: Optional[List[Tuple[float, float]]] = None, fast_mode: bool = False,
+                              save_circuit_indices: Optional[Set[int]] = None) -> List[Tuple[Dict[int, int], Tuple[float, float]]]:
+    """
+    Run QAOA for multiple cost vectors (one per location) in a single batched job.
+
+    save_circuit_indices selects batch positions whose circuit diagram should
+    be saved, so callers no longer need a separate single run for that.
+
+    Returns a list of tuples (counts_by_index, best_pair) in the same order as costs_list.
+    """
+    if save_circuit_indices:
+        for loc_idx in sorted(save_circuit_indices):
+            if loc_idx < len(costs_list):
+                template, _, _ = build_qaoa_template(costs_list[loc_idx], p, A)
+                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                save_circuit_visualization_async(template, f"qaoa_circuit_{len(costs_list[loc_idx])}qubits_{p}layers_{timestamp}")
+
+    # Use adaptive grid for all locations (take average problem size)
+    if grid is None:
+        avg_size = sum(len(c) for c in costs_list) / len(costs_list)
+        dummy_costs = np.zeros(int(avg_size))
+        grid = get_adaptive_grid(dummy_costs, fast_mode)
+    
+    print(f"Batch QAOA with {len(grid)} parameter combinations, fast_mode={fast_mode}")
+
+    K_list = [len(c) for c in costs_list]
+
+    # One fully parameterized template per distinct K, transpiled once; the
+    # rotation angles absorb the cost coefficients, so every (location,
+    # grid-point) circuit is a cheap assign_parameters on the shared
+    # transpiled template instead of a fresh build + transpile.
+    pm = _pm_for(backend)
+    templates: Dict[int, Tuple[QuantumCircuit, ParameterVector, Parameter, Parameter]] = {}
+    transpiled = []
+    for costs in costs_list:
+        K = len(costs)
+        if K not in templates:
+            circ, th, ph, bt = build_qaoa_param_template(K, p)
+            templates[K] = (pm.run(circ), th, ph, bt)
+        t_template, th, ph, bt = templates[K]
+        h, J = _compute_h_coeffs(costs, A)
+        for g, b in grid:
+            binding = {th[i]: 2.0 * g * float(h[i]) for i in range(K)}
+            binding[ph] = 2.0 * g * float(J)
+            binding[bt] = 2.0 * b
+            transpiled.append(t_template.assign_parameters(binding))
+
+    # Two-stage adaptive shot schedule: screen every (location, grid) circuit
+    # with a tenth of the budget just to rank (gamma, beta), then spend the
+    # full budget only on each location's winning circuit. The argmin choice
+    # tolerates the noisier screen; the returned counts come from the
+    # full-shot refinement run.
+    shots_screen = max(shots // 10, 100)
+
+    sampler = Sampler(backend)
+    job = sampler.run(transpiled, shots=shots_screen)
+    results = job.result()
+
+    # Rank grid points per location from the screening counts. Circuits were
+    # appended grid-major per location, so index i maps to location i // G.
+    # All G histograms of one location share its cost vector, so they are
+    # stacked into a single bit matrix, costed in one _bit_costs pass, and
+    # segment-summed with np.add.reduceat instead of G separate energy calls.
+    G = len(grid)
+    best_idx_by_loc: Dict[int, int] = {}
+    for m_loc, costs in enumerate(costs_list):
+        K = len(costs)
+        seg_codes: List[np.ndarray] = []
+        seg_wts: List[np.ndarray] = []
+        offsets = np.empty(G, dtype=np.intp)
+        n = 0
+        for g_idx in range(G):
+            data = results[m_loc * G + g_idx].data
+            if hasattr(data, 'meas'):
+                codes, wts = _counts_codes_from_meas(data.meas, K)
+            else:
+                codes, wts = _uniform_fallback(K, shots_screen)
+            if codes.size == 0:  # keep every reduceat segment non-empty
+                codes, wts = _uniform_fallback(K, shots_screen)
+            offsets[g_idx] = n
+            n += codes.size
+            seg_codes.append(codes)
+            seg_wts.append(wts)
+        bits = _bits_from_codes(np.concatenate(seg_codes), K)
+        w = np.concatenate(seg_wts).astype(np.float64)
+        E = np.add.reduceat(_bit_costs(bits, costs, A) * w, offsets) / float(shots_screen)
+        best_idx_by_loc[m_loc] = m_loc * G + int(np.argmin(E))
+
+    # Refinement: one full-shot circuit per location
+    refine_idx = [best_idx_by_loc[loc_idx] for loc_idx in range(len(costs_list))]
+    refine_job = sampler.run([transpiled[i] for i in refine_idx], shots=shots)
+    refine_results = refine_job.result()
+
+    # Aggregate per-location best results
+    per_location_outputs: List[Tuple[Dict[int, int], Tuple[float, float]]] = []
+    for loc_idx, costs in enumerate(costs_list):
+        best_pair = grid[best_idx_by_loc[loc_idx] % G]
+        data = refine_results[loc_idx].data
+        if hasattr(data, 'meas'):
+            codes, wts = _counts_codes_from_meas(data.meas, len(costs))
+        else:
+            codes, wts = _uniform_fallback(len(costs), shots)
+
+        # Convert the outcome histogram to index counts similar to the
+        # single-run function, in one vectorized pass over distinct codes
+        bits = _bits_from_codes(codes, len(costs))
+        w = wts.astype(np.float64)
+        valid = bits.sum(axis=1) == 1
+        valid_shots = int(w[valid].sum())
+        counts_by_index: Dict[int, int] = {}
+        if valid.any():
+            tally = np.bincount(bits[valid].argmax(axis=1), weights=w[valid], minlength=len(costs))
+            counts_by_index = {j: int(c) for j, c in enumerate(tally) if c > 0}
+
+        if not counts_by_index or valid_shots == 0:
+            idx = int(np.argmin(costs))
+            counts_by_index = {idx: shots}
+
+        per_location_outputs.append((counts_by_index, best_pair))
+
     return per_location_outputs
\ No newline at end of file
@@ -83,6 +83,26 @@ def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return R * c
 
 
+# Optional: numba compiles the scalar kernel to native code; nogil lets
+# threaded callers overlap the trig work. Every module importing
+# haversine_km from here shares the one compiled kernel.
+try:
+    from numba import njit
+    haversine_km = njit(cache=True, nogil=True, fastmath=True)(haversine_km)
+except ImportError:
+    pass
+
+
+def haversine_km_vec(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Vectorized haversine over NumPy arrays; broadcasts like a ufunc."""
+    p1 = np.radians(lat1)
+    p2 = np.radians(lat2)
+    dphi = np.radians(np.subtract(lat2, lat1))
+    dlmb = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(dphi / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dlmb / 2) ** 2
+    return 2.0 * 6371.0 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
 def minmax_scale(values: np.ndarray, eps: float = 1e-9) -> np.ndarray:
     vmin = float(np.min(values))
     vmax = float(np.max(values))
@@ -118,49 +138,47 @@ def preprocess_to_features(raw: Dict) -> Tuple[pd.DataFrame, Dict[str, Vehicle],
 
     depots = {d["id"]: Depot(id=d["id"], lat=float(d["lat"]), lon=float(d["lon"])) for d in raw["depots"]}
 
-    loc_rows = []
-    for l in raw["locations"]:
-        # Handle different possible field names for location ID
-        loc_id = l.get("id") or l.get("location_id")
-        if not loc_id:
-            raise ValueError("Location must have 'id' or 'location_id' field")
-            
-        loc = Location(
-            id=loc_id, 
-            lat=float(l["lat"]), 
-            lon=float(l["lon"]),
-            demand=float(l.get("demand", 0)),  # Default to 0 demand
-            priority=int(l.get("priority", 3)),  # Default to priority 3
-            time_window=(
-                float(l.get("time_window", [0, 24])[0]), 
-                float(l.get("time_window", [0, 24])[1])
-            )  # Default to 24-hour window
-        )
-        
-        # distance to nearest depot
-        nearest_depot_id, nearest_km = None, float("inf")
-        for dep in depots.values():
-            d_km = haversine_km(loc.lat, loc.lon, dep.lat, dep.lon)
-            if d_km < nearest_km:
-                nearest_km = d_km
-                nearest_depot_id = dep.id
-
-        tw_start, tw_end = loc.time_window
-        tw_width = max(0.0, tw_end - tw_start)
-        loc_rows.append({
-            "location_id": loc.id,
-            "lat": loc.lat,
-            "lon": loc.lon,
-            "demand": loc.demand,
-            "priority": loc.priority,
-            "tw_start": tw_start,
-            "tw_end": tw_end,
-            "tw_width": tw_width,
-            "nearest_depot_id": nearest_depot_id,
-            "distance_to_nearest_depot_km": nearest_km,
-        })
-
-    df = pd.DataFrame(loc_rows)
+    # Parse all locations columnwise instead of materializing a Location
+    # object plus a row dict per entry; defaults are filled as columns
+    ldf = pd.json_normalize(raw["locations"])
+
+    # Handle different possible field names for location ID
+    ids = ldf["id"] if "id" in ldf.columns else pd.Series([None] * len(ldf))
+    if "location_id" in ldf.columns:
+        ids = ids.combine_first(ldf["location_id"])
+    if ids.isna().any():
+        raise ValueError("Location must have 'id' or 'location_id' field")
+
+    # Default to a 24-hour window when time_window is absent or malformed
+    tw_src = ldf["time_window"] if "time_window" in ldf.columns else [None] * len(ldf)
+    tw = np.array([t if isinstance(t, (list, tuple)) else (0.0, 24.0) for t in tw_src],
+                  dtype=np.float64).reshape(len(ldf), 2)
+
+    df = pd.DataFrame({
+        "location_id": ids.to_numpy(),
+        "lat": ldf["lat"].to_numpy(dtype=float),
+        "lon": ldf["lon"].to_numpy(dtype=float),
+        "demand": (ldf["demand"].fillna(0).to_numpy(dtype=float)
+                   if "demand" in ldf.columns else np.zeros(len(ldf))),
+        "priority": (ldf["priority"].fillna(3).to_numpy(dtype=int)
+                     if "priority" in ldf.columns else np.full(len(ldf), 3)),
+        "tw_start": tw[:, 0],
+        "tw_end": tw[:, 1],
+    })
+    df["tw_width"] = np.maximum(0.0, df["tw_end"] - df["tw_start"])
+
+    # Nearest depot for every location from one broadcast haversine over the
+    # full location x depot grid instead of a scalar trig call per pair
+    dep_ids = np.array(list(depots.keys()))
+    dep_lat = np.fromiter((d.lat for d in depots.values()), dtype=np.float64, count=len(depots))
+    dep_lon = np.fromiter((d.lon for d in depots.values()), dtype=np.float64, count=len(depots))
+    dmat = haversine_km_vec(
+        df["lat"].to_numpy()[:, None], df["lon"].to_numpy()[:, None],
+        dep_lat[None, :], dep_lon[None, :]
+    )
+    nearest = dmat.argmin(axis=1)
+    df["nearest_depot_id"] = dep_ids[nearest]
+    df["distance_to_nearest_depot_km"] = dmat[np.arange(len(df)), nearest]
 
     # Scale features to [0,1]
     df["demand_scaled"] = minmax_scale(df["demand"].to_numpy())
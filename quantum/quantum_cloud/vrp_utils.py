@@ -4,18 +4,11 @@ from typing import List, Dict, Tuple
 import os
 import numpy as np
 
+from vrp_data import haversine_km  # shared (optionally numba-compiled) kernel
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Calculate the great-circle distance between two points on the Earth in kilometers."""
-    R = 6371.0  # Earth radius in kilometers
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
 def get_distance_matrix(origins: List[Dict], destinations: List[Dict]) -> Tuple[List[List[float]], List[List[float]]]:
     """Fetch driving distance (km) and duration (hours) matrices."""
     try: